@@ -9,55 +9,36 @@ import random
 from PIL import Image
 from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize
 from model.simple_tokenizer import SimpleTokenizer as Tokenizer
+from .caption_cache import CaptionCache
+from .image_shards import ImageShards
+from .manifest import RowView, LabelColumn
 
+import numpy as np
 from numpy import array
 
 
-import pickle
-from scipy.io import loadmat
 
 class BaseDataset(Dataset):
 
     def __init__(self, 
 
-            captions: dict,
-            indexs: dict,
-            labels: dict,
+            captions,
+            indexs,
+            labels,
+            ids=None,
             is_train=True,
             tokenizer=Tokenizer(),
             maxWords=32,
             imageResolution=224,
-            npy=False):
+            npy=False,
+            caption_cache=None,
+            image_shards=None,
+            raw_images=False):
         
-        input_filename = "/root/autodl-tmp/DDLCH/dataset/or5k/captions.pkl"  # 你之前保存的 pickle 文件名
-        # 从 pickle 文件中读取内容并赋值给 self.labels
-        with open(input_filename, "rb") as input_file:
-              captions = pickle.load(input_file)
-        # # input_filename = "/root/autodl-tmp/DCHMT-main/dataset/flickr25k/caption.mat"   # 你要读取的 .mat 文件名
-        # # # 从 .mat 文件中读取内容
-        # # captions = loadmat(input_filename)              
+        # sequences of the split, usually RowView of the source columns loaded once by dataset.dataloader
         self.captions = captions
-        
-        input_filename = "/root/autodl-tmp/DDLCH/dataset/or5k/index.pkl"  # 你之前保存的 pickle 文件名
-        # 从 pickle 文件中读取内容并赋值给 self.labels
-        with open(input_filename, "rb") as input_file:
-              indexs = pickle.load(input_file)
-        # # input_filename = "/root/autodl-tmp/DCHMT-main/dataset/flickr25k/index.mat"   # 你要读取的 .mat 文件名
-        # # # 从 .mat 文件中读取内容
-        # # index = loadmat(input_filename)             
         self.indexs = indexs
-       
-        input_filename = "/root/autodl-tmp/DDLCH/dataset/or5k/labels.pkl"  # 你之前保存的 pickle 文件名
-        # 从 pickle 文件中读取内容并赋值给 self.labels
-        with open(input_filename, "rb") as input_file:
-              labels = pickle.load(input_file)   
-        # # input_filename = "/root/autodl-tmp/DCHMT-main/dataset/flickr25k/label.mat"   # 你要读取的 .mat 文件名
-        # # # 从 .mat 文件中读取内容
-        # # labels = loadmat(input_filename)      
         self.labels = labels
-        # self.captions = captions
-        # self.indexs = indexs
-        # self.labels = labels
         self.npy = npy
 
         self.maxWords = maxWords
@@ -77,6 +58,17 @@ class BaseDataset(Dataset):
                               "MASK_TOKEN": "[MASK]", "UNK_TOKEN": "[UNK]", "PAD_TOKEN": "[PAD]"}
         
         self.__length = len(self.indexs)
+        # item ids used to find stored codes of this data, default to the row numbers
+        self.ids = np.arange(self.__length) if ids is None else np.asarray(ids)
+        # pre-tokenized captions, _load_text slices ids from it instead of running the tokenizer
+        self.caption_cache = CaptionCache.load_or_build(self.captions, self.tokenizer, caption_cache) if caption_cache else None
+        # decoded images already resized like self.transform, only ToTensor and Normalize are left
+        self.image_shards = ImageShards(ImageShards.subdir(image_shards, "train" if is_train else "eval", imageResolution)) if image_shards else None
+        self.normalize = Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
+        # return decoded uint8 images, resize / crop, ToTensor and Normalize are done on whole batches by dataset/preprocess.py
+        self.raw_images = raw_images
+        self.is_train = is_train
+        self.resolution = imageResolution
         
     def __len__(self):
         return self.__length
@@ -85,19 +77,38 @@ class BaseDataset(Dataset):
         if not self.npy:
             # print(111111111111111)
             # print(index)
-            image_path = self.indexs[index-1].strip()
+            image_path = self.indexs[index].strip()
             # print(image_path)
-            image = Image.open(image_path).convert("RGB")
-        else:
-            image = Image.fromarray(self.indexs[index]-1).convert("RGB")
+            return self.load_image_file(image_path)
+        image = Image.fromarray(self.indexs[index]-1).convert("RGB")
+        return self.transform_image(image)
+
+    def load_image_file(self, image_path: str) -> torch.Tensor:
+        if self.image_shards is not None and image_path in self.image_shards:
+            image = torch.from_numpy(np.array(self.image_shards.get(image_path))).permute(2, 0, 1)
+            return image if self.raw_images else self.normalize(image.float().div(255))
+        image = Image.open(image_path)
+        if self.raw_images:
+            # jpegs are decoded at the smallest scale still covering the resolution, the exact resize is on the device
+            image.draft("RGB", (self.resolution, self.resolution))
+        return self.transform_image(image.convert("RGB"))
+
+    def transform_image(self, image: Image.Image) -> torch.Tensor:
+        if self.raw_images:
+            return torch.from_numpy(np.asarray(image, dtype=np.uint8).copy()).permute(2, 0, 1)
         image = self.transform(image)
 
         return image
 
     def _load_text(self, index: int):
-        captions = self.captions[index-1]
+        if self.caption_cache is not None:
+            return self._load_cached_text(index)
+        captions = self.captions[index]
         use_cap = captions[random.randint(0, len(captions) - 1)]
 
+        return self.encode_caption(use_cap)
+
+    def encode_caption(self, use_cap: str) -> torch.Tensor:
         words = self.tokenizer.tokenize(use_cap)
         words = [self.SPECIAL_TOKEN["CLS_TOKEN"]] + words
         total_length_with_CLS = self.maxWords - 1
@@ -113,13 +124,44 @@ class BaseDataset(Dataset):
 
         return caption
     
+    def _load_cached_text(self, index: int):
+        # same ids as _load_text: CLS, at most maxWords - 2 caption ids, SEP, zero padding
+        ids = self.caption_cache.caption(index, random.randint(0, self.caption_cache.num_captions(index) - 1))[: self.maxWords - 2]
+        caption = np.zeros(self.maxWords, dtype=np.int64)
+        caption[0] = self.tokenizer.encoder[self.SPECIAL_TOKEN["CLS_TOKEN"]]
+        caption[1: len(ids) + 1] = ids
+        caption[len(ids) + 1] = self.tokenizer.encoder[self.SPECIAL_TOKEN["SEP_TOKEN"]]
+
+        return torch.from_numpy(caption)
+
+    def text_lengths(self) -> np.ndarray:
+        """
+        :return: int64 (num_items,), token length of the longest caption of every item with CLS and SEP, at most maxWords
+        """
+        if self.caption_cache is not None:
+            cache = self.caption_cache
+            caption_lengths = np.diff(np.asarray(cache.caption_offsets))
+            items = np.repeat(np.arange(len(cache)), np.diff(np.asarray(cache.item_offsets)))
+            lengths = np.zeros(len(cache), dtype=np.int64)
+            np.maximum.at(lengths, items, caption_lengths)
+        else:
+            lengths = np.asarray([max([len(self.tokenizer.tokenize(str(caption))) for caption in item] + [0])
+                                  for item in self.captions], dtype=np.int64)
+        return np.minimum(lengths + 2, self.maxWords)
+
     def _load_label(self, index: int) -> torch.Tensor:
-        label = self.labels[index-1]
-        label = torch.from_numpy(label)
+        label = self.labels[index]
+        label = torch.as_tensor(label).float()
 
         return label
 
     def get_all_label(self):
+        if isinstance(self.labels, RowView) and isinstance(self.labels.source, torch.Tensor):
+            # rows of the shared uint8 label matrix, no copy when the split is one range of it
+            return self.labels.take()
+        if isinstance(self.labels, RowView) and isinstance(self.labels.source, LabelColumn):
+            # packed manifest labels, only the rows of the split are unpacked
+            return torch.from_numpy(self.labels.source.unpack(self.labels.rows))
         # print(len(self.labels))
         labels = torch.zeros([self.__length, len(self.labels[0])], dtype=torch.int64)
         # print("self.__length")
@@ -127,7 +169,7 @@ class BaseDataset(Dataset):
         # print(labels)
         for i, item in enumerate(self.labels):
             # print(self.labels)
-            labels[i] = torch.from_numpy(item)
+            labels[i] = torch.as_tensor(item)
         return labels
 
     def __getitem__(self, index):
@@ -0,0 +1,47 @@
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class LengthBucketSampler(Sampler):
+    """
+    batch sampler grouping items of similar caption length, CLIP.encode_text only runs the positions up to the
+    longest caption of a batch. with shuffle the items are shuffled every epoch, cut into buckets of
+    `bucket_size` batches, sorted by length inside a bucket and the batches of all buckets are shuffled, so a
+    batch is still a random sample of its bucket. without shuffle every item is sorted by length.
+    """
+
+    def __init__(self, lengths, batch_size: int, shuffle=True, bucket_size=50, drop_last=False, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        if self.drop_last:
+            return self.lengths.shape[0] // self.batch_size
+        return (self.lengths.shape[0] + self.batch_size - 1) // self.batch_size
+
+    def batches(self) -> list:
+        if not self.shuffle:
+            order = np.argsort(self.lengths, kind="stable")
+            return [order[i: i + self.batch_size] for i in range(0, order.shape[0], self.batch_size)]
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = rng.permutation(self.lengths.shape[0])
+        step = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, order.shape[0], step):
+            bucket = order[start: start + step]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            batches += [bucket[i: i + self.batch_size] for i in range(0, bucket.shape[0], self.batch_size)]
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def __iter__(self):
+        batches = self.batches()
+        self.epoch += 1
+        for batch in batches:
+            if self.drop_last and batch.shape[0] < self.batch_size:
+                continue
+            yield batch.tolist()
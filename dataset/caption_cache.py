@@ -0,0 +1,72 @@
+import hashlib
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+
+def caption_fingerprint(captions) -> str:
+    # a cache is only reused for exactly the same captions
+    sha = hashlib.sha1()
+    for item in captions:
+        for caption in item:
+            sha.update(str(caption).encode("utf-8"))
+            sha.update(b"\x00")
+        sha.update(b"\x01")
+    return sha.hexdigest()[:16]
+
+
+class CaptionCache(object):
+    """
+    bpe ids of every caption, tokenized once and memory mapped:
+        tokens: int32, ids of all captions one after another.
+        caption_offsets: int64 (num_captions + 1,), caption c is tokens[caption_offsets[c]: caption_offsets[c + 1]].
+        item_offsets: int64 (num_items + 1,), the captions of item i are item_offsets[i] to item_offsets[i + 1] - 1.
+    the ids have no start / end token and are not truncated, so one cache serves every maxWords.
+    """
+
+    NAMES = ["tokens", "caption_offsets", "item_offsets"]
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.tokens, self.caption_offsets, self.item_offsets = [np.load(path, mmap_mode="r") for path in self.paths(prefix)]
+
+    @classmethod
+    def paths(cls, prefix: str) -> list:
+        return [prefix + "-" + name + ".npy" for name in cls.NAMES]
+
+    @classmethod
+    def build(cls, captions, tokenizer, prefix: str):
+        tokens = []
+        caption_offsets = [0]
+        item_offsets = [0]
+        for item in tqdm(captions):
+            for caption in item:
+                ids = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(str(caption)))
+                tokens.extend(ids)
+                caption_offsets.append(len(tokens))
+            item_offsets.append(len(caption_offsets) - 1)
+        arrays = [np.asarray(tokens, dtype=np.int32), np.asarray(caption_offsets, dtype=np.int64), np.asarray(item_offsets, dtype=np.int64)]
+        for path, array in zip(cls.paths(prefix), arrays):
+            # np.save adds .npy to a name without it
+            np.save(path + ".tmp.npy", array)
+            os.replace(path + ".tmp.npy", path)
+        return cls(prefix)
+
+    @classmethod
+    def load_or_build(cls, captions, tokenizer, cache_dir: str):
+        os.makedirs(cache_dir, exist_ok=True)
+        prefix = os.path.join(cache_dir, "captions-" + caption_fingerprint(captions))
+        if all(os.path.exists(path) for path in cls.paths(prefix)):
+            return cls(prefix)
+        return cls.build(captions, tokenizer, prefix)
+
+    def __len__(self):
+        return self.item_offsets.shape[0] - 1
+
+    def num_captions(self, item: int) -> int:
+        return int(self.item_offsets[item + 1] - self.item_offsets[item])
+
+    def caption(self, item: int, k: int) -> np.ndarray:
+        c = self.item_offsets[item] + k
+        return self.tokens[self.caption_offsets[c]: self.caption_offsets[c + 1]]
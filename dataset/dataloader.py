@@ -1,5 +1,6 @@
 
 from .base import BaseDataset
+from .manifest import Manifest, RowView, PathBuffer, share_labels
 import os
 import numpy as np
 import scipy.io as scio
@@ -12,34 +13,26 @@ def split_data(captions, indexs, labels, query_num=1000, train_num=6430, seed=No
     train_index = random_index[query_num: query_num + train_num]
     retrieval_index = random_index[query_num:]
 
-    query_indexs = indexs[query_index]
-    query_captions = captions[query_index]
-    query_labels = labels[query_index]
+    query_indexs = RowView(indexs, query_index)
+    query_captions = RowView(captions, query_index)
+    query_labels = RowView(labels, query_index)
     
-    train_indexs = indexs[train_index]
-    train_captions = captions[train_index]
-    train_labels = labels[train_index]
+    train_indexs = RowView(indexs, train_index)
+    train_captions = RowView(captions, train_index)
+    train_labels = RowView(labels, train_index)
 
-    retrieval_indexs = indexs[retrieval_index]
-    retrieval_captions = captions[retrieval_index]
-    retrieval_labels = labels[retrieval_index]
+    retrieval_indexs = RowView(indexs, retrieval_index)
+    retrieval_captions = RowView(captions, retrieval_index)
+    retrieval_labels = RowView(labels, retrieval_index)
     
     split_indexs = (query_indexs, train_indexs, retrieval_indexs)
     split_captions = (query_captions, train_captions, retrieval_captions)
     split_labels = (query_labels, train_labels, retrieval_labels)
-    return split_indexs, split_captions, split_labels
+    # rows of the source files, stable item ids when new data is appended to the files
+    split_ids = (query_index, train_index, retrieval_index)
+    return split_indexs, split_captions, split_labels, split_ids
 
-def dataloader(captionFile: str,
-                indexFile: str,
-                labelFile: str,
-                maxWords=64,
-                imageResolution=224,
-                query_num=1000, 
-                train_num=6430,
-                # query_num=5000, 
-                # train_num=10000, 
-                seed=None,
-                npy=False):
+def load_files(captionFile: str, indexFile: str, labelFile: str, npy=False):
     if captionFile.endswith("mat"):
         captions = scio.loadmat(captionFile)["caption"]
         captions = captions[0] if captions.shape[0] == 1 else captions
@@ -54,18 +47,46 @@ def dataloader(captionFile: str,
     else:
         indexs = np.load(indexFile, allow_pickle=True)
     labels = scio.loadmat(labelFile)["category"]
+    return captions, indexs, labels
+
+def dataloader(captionFile: str,
+                indexFile: str,
+                labelFile: str,
+                maxWords=64,
+                imageResolution=224,
+                query_num=1000, 
+                train_num=6430,
+                # query_num=5000, 
+                # train_num=10000, 
+                seed=None,
+                npy=False,
+                captionCache="",
+                imageShards="",
+                rawImages=False,
+                manifest=""):
+    if manifest != "":
+        # columnar, memory mapped source, see dataset/manifest.py. the columns are read lazily and the workers
+        # share their pages through the page cache already
+        source = Manifest(manifest)
+        captions, indexs, labels = source.captions, source.paths, source.labels
+    else:
+        captions, indexs, labels = load_files(captionFile, indexFile, labelFile, npy=npy)
+        # contiguous shared buffers, the workers map them instead of copying python objects
+        labels = share_labels(labels)
+        if not npy:
+            indexs = PathBuffer(indexs)
     # for item in ['__version__', '__globals__', '__header__']:
     #     captions.pop(item)
     #     indexs.pop(item)
     #     labels.pop(item)
     
-    split_indexs, split_captions, split_labels = split_data(captions, indexs, labels, query_num=query_num, train_num=train_num, seed=seed)
+    split_indexs, split_captions, split_labels, split_ids = split_data(captions, indexs, labels, query_num=query_num, train_num=train_num, seed=seed)
 
-    train_data = BaseDataset(captions=split_captions[1], indexs=split_indexs[1], labels=split_labels[1], maxWords=maxWords, imageResolution=imageResolution, npy=npy)
+    train_data = BaseDataset(captions=split_captions[1], indexs=split_indexs[1], labels=split_labels[1], ids=split_ids[1], maxWords=maxWords, imageResolution=imageResolution, npy=npy, caption_cache=captionCache, image_shards=imageShards, raw_images=rawImages)
     # print("Train_Data:", train_data)
-    query_data = BaseDataset(captions=split_captions[0], indexs=split_indexs[0], labels=split_labels[0], maxWords=maxWords, imageResolution=imageResolution, is_train=False, npy=npy)
+    query_data = BaseDataset(captions=split_captions[0], indexs=split_indexs[0], labels=split_labels[0], ids=split_ids[0], maxWords=maxWords, imageResolution=imageResolution, is_train=False, npy=npy, caption_cache=captionCache, image_shards=imageShards, raw_images=rawImages)
     # print("Query_Data:", query_data)    
-    retrieval_data = BaseDataset(captions=split_captions[2], indexs=split_indexs[2], labels=split_labels[2], maxWords=maxWords, imageResolution=imageResolution, is_train=False, npy=npy)
+    retrieval_data = BaseDataset(captions=split_captions[2], indexs=split_indexs[2], labels=split_labels[2], ids=split_ids[2], maxWords=maxWords, imageResolution=imageResolution, is_train=False, npy=npy, caption_cache=captionCache, image_shards=imageShards, raw_images=rawImages)
     # print("Retrieval_Data:", retrieval_data)
     
     return train_data, query_data, retrieval_data
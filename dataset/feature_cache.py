@@ -0,0 +1,112 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+
+from .preprocess import raw_collate
+
+
+def feature_paths(prefix: str) -> tuple:
+    return prefix + "-img.npy", prefix + "-txt.npy"
+
+
+def meta_path(prefix: str) -> str:
+    return prefix + "-meta.json"
+
+
+def feature_fingerprint(ids, files=(), **settings) -> str:
+    """
+    key of the embeddings of a split: the item ids, the model files (path, size and mtime, not the content)
+    and the settings that change the model input, e.g. max_words and resolution.
+    """
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(np.asarray(ids, dtype=np.int64)).tobytes())
+    for path in files:
+        if path != "" and os.path.exists(path):
+            stat = os.stat(path)
+            sha.update(("%s:%d:%d" % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)).encode("utf-8"))
+        else:
+            sha.update(("%s:missing" % path).encode("utf-8"))
+    sha.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    return sha.hexdigest()[:16]
+
+
+def build_features(clip, dataset: Dataset, prefix: str, batch_size=128, num_workers=4, device=0, preprocess=None, fingerprint=""):
+    """
+    run the clip backbone once over the dataset and save the image and text embeddings
+    as float32 .npy files that can be memory mapped, row i holds the embeddings of item i.
+    the caption of an item is sampled once here, so it is fixed for every epoch.
+    preprocess turns the loaded images into model input on the device, e.g. dataset.preprocess.BatchPreprocess.
+    fingerprint (see feature_fingerprint) is saved in the -meta.json file, FeatureDataset.exists checks it.
+    """
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True,
+                        collate_fn=raw_collate if preprocess is not None else None)
+    paths = feature_paths(prefix)
+    buffers = None
+    with torch.no_grad():
+        for image, text, label, index in tqdm(loader):
+            image = preprocess(image, crop=dataset.is_train) if preprocess is not None else image.to(device, non_blocking=True)
+            image_embed = clip.encode_image(image).float().cpu().numpy()
+            text_embed = clip.encode_text(text.to(device, non_blocking=True)).float().cpu().numpy()
+            if buffers is None:
+                # written next to the final files and renamed when complete, a broken build is never loaded
+                buffers = [np.lib.format.open_memmap(path + ".tmp", mode="w+", dtype=np.float32, shape=(len(dataset), embed.shape[1]))
+                           for path, embed in zip(paths, (image_embed, text_embed))]
+            index = index.numpy()
+            buffers[0][index] = image_embed
+            buffers[1][index] = text_embed
+    if buffers is None:
+        # empty dataset, the image and text embeddings both have the width of the text projection
+        buffers = [np.lib.format.open_memmap(path + ".tmp", mode="w+", dtype=np.float32, shape=(0, clip.text_projection.shape[1]))
+                   for path in paths]
+    for buffer in buffers:
+        buffer.flush()
+    del buffers
+    for path in paths:
+        os.replace(path + ".tmp", path)
+    # the meta file is written last, a cache without it is rebuilt
+    with open(meta_path(prefix) + ".tmp", "w") as f:
+        json.dump({"count": len(dataset), "fingerprint": fingerprint}, f)
+    os.replace(meta_path(prefix) + ".tmp", meta_path(prefix))
+    return paths
+
+
+class FeatureDataset(Dataset):
+    """
+    cached clip embeddings of a BaseDataset, items are (image embedding, text embedding, label, index)
+    so the trainer consumes them like images and captions when the model hashes features directly.
+    """
+
+    def __init__(self, prefix: str, labels: torch.Tensor, ids=None):
+        img_path, txt_path = feature_paths(prefix)
+        self.image_features = np.load(img_path, mmap_mode="r")
+        self.text_features = np.load(txt_path, mmap_mode="r")
+        if not (self.image_features.shape[0] == self.text_features.shape[0] == labels.shape[0]):
+            raise ValueError("feature cache %s holds %d items, but the dataset has %d items." % (prefix, self.image_features.shape[0], labels.shape[0]))
+        self.labels = labels
+        self.ids = np.arange(labels.shape[0]) if ids is None else np.asarray(ids)
+
+    @classmethod
+    def exists(cls, prefix: str, fingerprint="") -> bool:
+        """
+        :return: True if the cache is complete and was built with the same fingerprint
+        """
+        if not all(os.path.exists(path) for path in feature_paths(prefix) + (meta_path(prefix),)):
+            return False
+        with open(meta_path(prefix), "r") as f:
+            return json.load(f).get("fingerprint", "") == fingerprint
+
+    def __len__(self):
+        return self.labels.shape[0]
+
+    def get_all_label(self):
+        return self.labels
+
+    def __getitem__(self, index):
+        image = torch.from_numpy(np.array(self.image_features[index]))
+        text = torch.from_numpy(np.array(self.text_features[index]))
+        return image, text, self.labels[index], index
@@ -0,0 +1,102 @@
+import json
+import os
+
+import numpy as np
+
+
+class ImageShards(object):
+    """
+    decoded and resized uint8 images in fixed-size binary shards, written by dataset/or5k/make_image_shards.py:
+        meta.json: resolution, mode (train: Resize + CenterCrop, eval: Resize to a square), shard size, count.
+        index.npz: image path, shard number and row inside the shard of every image.
+        shard-{k}.u8: raw uint8 array with shape (rows, resolution, resolution, 3).
+    shards are memory mapped on first use in every process and images are returned as views.
+    """
+
+    META = "meta.json"
+    INDEX = "index.npz"
+
+    def __init__(self, root: str):
+        self.root = root
+        with open(os.path.join(root, self.META), "r") as f:
+            self.meta = json.load(f)
+        self.resolution = self.meta["resolution"]
+        self.mode = self.meta["mode"]
+        index = np.load(os.path.join(root, self.INDEX))
+        self.paths = index["paths"]
+        self.shard = index["shard"]
+        self.row = index["row"]
+        self.rows = {str(path): i for i, path in enumerate(self.paths)}
+        self._maps = {}
+
+    @staticmethod
+    def shard_name(k: int) -> str:
+        return "shard-%05d.u8" % k
+
+    @staticmethod
+    def subdir(root: str, mode: str, resolution: int) -> str:
+        return os.path.join(root, "%s-%d" % (mode, resolution))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, path: str):
+        return path in self.rows
+
+    def __getstate__(self):
+        # memory maps are opened again in the worker processes
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        return state
+
+    def _map(self, k: int) -> np.ndarray:
+        if k not in self._maps:
+            path = os.path.join(self.root, self.shard_name(k))
+            self._maps[k] = np.memmap(path, dtype=np.uint8, mode="r").reshape(-1, self.resolution, self.resolution, 3)
+        return self._maps[k]
+
+    def get(self, path: str) -> np.ndarray:
+        """
+        :return: read-only (resolution, resolution, 3) uint8 view
+        """
+        i = self.rows[path]
+        return self._map(int(self.shard[i]))[int(self.row[i])]
+
+
+class ShardWriter(object):
+    """
+    append images to a new ImageShards directory, close() writes the index and the meta data.
+    """
+
+    def __init__(self, root: str, resolution: int, mode: str, shard_size=4096):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.resolution = resolution
+        self.mode = mode
+        self.shard_size = shard_size
+        self.paths = []
+        self._file = None
+        self._rows = 0
+
+    def add(self, path: str, image: np.ndarray):
+        if image.shape != (self.resolution, self.resolution, 3) or image.dtype != np.uint8:
+            raise ValueError("image %s with shape %s is not a (%d, %d, 3) uint8 array." % (path, str(image.shape), self.resolution, self.resolution))
+        if self._file is None or self._rows == self.shard_size:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(os.path.join(self.root, ImageShards.shard_name(len(self.paths) // self.shard_size)), "wb")
+            self._rows = 0
+        self._file.write(np.ascontiguousarray(image).tobytes())
+        self.paths.append(path)
+        self._rows += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        count = len(self.paths)
+        position = np.arange(count)
+        # meta.json is written last, a directory without it is an unfinished build
+        np.savez(os.path.join(self.root, ImageShards.INDEX), paths=np.asarray(self.paths, dtype=str),
+                 shard=position // self.shard_size, row=position % self.shard_size)
+        with open(os.path.join(self.root, ImageShards.META), "w") as f:
+            json.dump({"resolution": self.resolution, "mode": self.mode, "shard_size": self.shard_size, "count": count}, f)
@@ -0,0 +1,182 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+
+class RowView(object):
+    """
+    rows of a source column without copying it, item i is source[rows[i]].
+    the train / query / retrieval splits are views of the same source arrays.
+    """
+
+    def __init__(self, source, rows):
+        self.source = source
+        self.rows = np.asarray(rows, dtype=np.int64)
+
+    def __len__(self):
+        return self.rows.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self.source[int(self.rows[index])]
+        return RowView(self.source, self.rows[index])
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self.source[int(row)]
+
+    def take(self):
+        # every row at once, a view of the source when the rows are one ascending range
+        rows = self.rows
+        if rows.shape[0] > 0 and rows[-1] - rows[0] + 1 == rows.shape[0] and np.all(np.diff(rows) == 1):
+            return self.source[int(rows[0]): int(rows[-1]) + 1]
+        if isinstance(self.source, torch.Tensor):
+            return self.source[torch.from_numpy(rows)]
+        return self.source[rows]
+
+
+class PathBuffer(object):
+    """
+    strings stored as one utf-8 byte buffer with int64 offsets in shared memory. there is no python object
+    per item, so DataLoader workers read the same pages instead of copying them on refcount writes.
+    """
+
+    def __init__(self, strings):
+        encoded = [str(item).encode("utf-8") for item in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(item) for item in encoded])
+        self.data = torch.from_numpy(np.frombuffer(b"".join(encoded), dtype=np.uint8).copy()).share_memory_()
+        self.offsets = torch.from_numpy(offsets).share_memory_()
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, index: int) -> str:
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        return self.data[start: end].numpy().tobytes().decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def share_labels(labels) -> torch.Tensor:
+    """
+    multi-hot labels as one (num_items, num_classes) uint8 tensor in shared memory.
+    """
+    if isinstance(labels, LabelColumn):
+        labels = np.unpackbits(np.asarray(labels.packed), axis=1, bitorder="little", count=labels.num_classes)
+    else:
+        labels = (np.asarray(labels) > 0).astype(np.uint8)
+    return torch.from_numpy(labels).share_memory_()
+
+
+class CaptionColumn(object):
+    """
+    captions of item i are captions[offsets[i]: offsets[i + 1]].
+    """
+
+    def __init__(self, captions: np.ndarray, offsets: np.ndarray):
+        self.captions = captions
+        self.offsets = offsets
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, index: int) -> list:
+        return [str(caption) for caption in self.captions[self.offsets[index]: self.offsets[index + 1]]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class LabelColumn(object):
+    """
+    multi-hot labels packed 8 per byte (little bit order), item i is unpacked on access.
+    """
+
+    def __init__(self, packed: np.ndarray, num_classes: int):
+        self.packed = packed
+        self.num_classes = num_classes
+
+    def __len__(self):
+        return self.packed.shape[0]
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        return np.unpackbits(self.packed[index], bitorder="little", count=self.num_classes).astype(np.float32)
+
+    def unpack(self, rows) -> np.ndarray:
+        """
+        :return: uint8 (len(rows), num_classes) labels of the rows, only their packed bytes are read
+        """
+        return np.unpackbits(np.asarray(self.packed[np.asarray(rows, dtype=np.int64)]), axis=1, bitorder="little", count=self.num_classes)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class PathColumn(object):
+    """
+    image path of item i, joined with the image root.
+    """
+
+    def __init__(self, paths: np.ndarray, root: str):
+        self.paths = paths
+        self.root = root
+
+    def __len__(self):
+        return self.paths.shape[0]
+
+    def __getitem__(self, index: int) -> str:
+        return os.path.normpath(os.path.join(self.root, str(self.paths[index])))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class Manifest(object):
+    """
+    columnar dataset written by dataset/or5k/make_or5k.py, manifest.json names the columns:
+        paths: (num_items,) image paths, relative to image_root.
+        captions: (num_captions,) caption strings, caption_offsets: (num_items + 1,) int64.
+        labels: (num_items, ceil(num_classes / 8)) packed uint8.
+    every column is an .npy file next to manifest.json, memory mapped on first access.
+    """
+
+    FILE = "manifest.json"
+
+    def __init__(self, path: str):
+        if os.path.isdir(path):
+            path = os.path.join(path, self.FILE)
+        self.root = os.path.dirname(os.path.abspath(path))
+        with open(path, "r") as f:
+            self.meta = json.load(f)
+        self.num_classes = self.meta["num_classes"]
+        image_root = self.meta.get("image_root", "")
+        self.image_root = image_root if os.path.isabs(image_root) else os.path.join(self.root, image_root)
+        self._columns = {}
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def column(self, name: str) -> np.ndarray:
+        if name not in self._columns:
+            self._columns[name] = np.load(os.path.join(self.root, self.meta["columns"][name]), mmap_mode="r")
+        return self._columns[name]
+
+    @property
+    def paths(self):
+        return PathColumn(self.column("paths"), self.image_root)
+
+    @property
+    def captions(self):
+        return CaptionColumn(self.column("captions"), self.column("caption_offsets"))
+
+    @property
+    def labels(self):
+        return LabelColumn(self.column("labels"), self.num_classes)
@@ -0,0 +1,72 @@
+"""
+decode and resize the images of a manifest (or index.pkl / index.mat) once and write them to uint8 shards,
+BaseDataset reads them with --image-shards instead of opening the jpg files.
+
+    python dataset/or5k/make_image_shards.py --index-file index.pkl --output ./dataset/or5k/shards --resolution 224
+"""
+import os
+import sys
+import pickle
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.io as scio
+from PIL import Image
+from torchvision.transforms import Compose, Resize, CenterCrop
+from tqdm import tqdm
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from dataset.image_shards import ImageShards, ShardWriter
+from dataset.manifest import Manifest
+
+
+def load_paths(index_file: str) -> list:
+    if os.path.isdir(index_file) or index_file.endswith("json"):
+        return list(Manifest(index_file).paths)
+    if index_file.endswith("pkl"):
+        with open(index_file, "rb") as f:
+            paths = pickle.load(f)
+    elif index_file.endswith("mat"):
+        paths = scio.loadmat(index_file)["index"]
+    else:
+        raise ValueError("the format of 'index_file' doesn't support, only support [manifest, pkl, mat] format.")
+    return [str(path).strip() for path in paths]
+
+
+def geometry(mode: str, resolution: int):
+    # the geometric part of the BaseDataset transforms, ToTensor and Normalize are done when loading
+    if mode == "train":
+        return Compose([Resize(resolution, interpolation=Image.BICUBIC), CenterCrop(resolution)])
+    return Resize((resolution, resolution), interpolation=Image.BICUBIC)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index-file", type=str, default="index.pkl")
+    parser.add_argument("--output", type=str, default="./dataset/or5k/shards")
+    parser.add_argument("--resolution", type=int, default=224)
+    parser.add_argument("--mode", type=str, default="all", help="choise from [train, eval, all].")
+    parser.add_argument("--shard-size", type=int, default=4096, help="images per shard file.")
+    parser.add_argument("--num-workers", type=int, default=8, help="threads decoding images.")
+    args = parser.parse_args()
+
+    paths = load_paths(args.index_file)
+    modes = ["train", "eval"] if args.mode == "all" else [args.mode]
+    for mode in modes:
+        transform = geometry(mode, args.resolution)
+
+        def load(path):
+            return np.asarray(transform(Image.open(path).convert("RGB")), dtype=np.uint8)
+
+        root = ImageShards.subdir(args.output, mode, args.resolution)
+        writer = ShardWriter(root, args.resolution, mode, shard_size=args.shard_size)
+        with ThreadPoolExecutor(args.num_workers) as pool:
+            for path, image in tqdm(zip(paths, pool.map(load, paths)), total=len(paths)):
+                writer.add(path, image)
+        writer.close()
+        print("%s: %d images written to %s" % (mode, len(paths), root))
+
+
+if __name__ == "__main__":
+    main()
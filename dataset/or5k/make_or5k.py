@@ -1,118 +1,130 @@
-import os
-import scipy.io as scio
-import numpy as np
+"""
+build the columnar or5k dataset read by dataset.manifest.Manifest (--manifest):
+    every annotation file in --annotation-dir is a category, its lines are the ids of the items in it.
+    the caption of item <id> is the tags file tags<id>.txt in --caption-dir and its image is im<id>.jpg in --image-dir.
 
-import pickle
+    python dataset/or5k/make_or5k.py --output ./dataset/or5k/manifest
+    python dataset/or5k/make_or5k.py --output ./dataset/or5k/manifest --update    # only scan new annotation files
 
-root_dir = "/root/autodl-tmp/DDLCH/dataset/or5k/ork"
+the index.mat / caption.mat / label.mat files read by main.py without --manifest are written to --mat-dir
+as well, --no-mat only writes the manifest.
 
-# file_path = os.path.join(root_dir, "/mirflickr25k_annotations_v080")
-# file_path = r"D:\CWNU\Papers\CMH+transformer\DCHMT-main\dataset\flickr25k\mirflickr25k_annotations_v080"
-file_path = "/root/autodl-tmp/DDLCH/dataset/or5k/ork_annotations"
-file_list = os.listdir(file_path)
-
-file_list = [item for item in file_list if "_r1" not in item and "README" not in item]
+with --update the categories and items already in the manifest keep their columns and rows, new categories
+are appended to the label columns and new items to the rows, so item ids stay valid for stored hash codes.
+changes inside annotation files that are already in the manifest need a full build.
+"""
+import os
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+import scipy.io as scio
 
-print("class num:", len(file_list))
+ROOT_DIR = "/root/autodl-tmp/DDLCH/dataset/or5k"
+COLUMNS = {"keys": "keys.npy", "paths": "paths.npy", "captions": "captions.npy",
+           "caption_offsets": "caption_offsets.npy", "labels": "labels.npy"}
 
-class_index = {}
-for i, item in enumerate(file_list):          
-    class_index.update({item: i})
 
-label_dict = {}
-for path_id in file_list:
-    path = os.path.join(file_path, path_id)
+def read_annotation(path: str) -> list:
     with open(path, "r") as f:
-        for item in f:
-            # print("item:", item)
-            item = item.strip()
-            if item not in label_dict:
-                label = np.zeros(len(file_list))
-                label[class_index[path_id]] = 1
-                label_dict.update({item: label})
-            else:
-                # print()
-                label_dict[item][class_index[path_id]] = 1
-
-# print(label_dict)
-print("create label:", len(label_dict))
-keys = list(label_dict.keys())
-keys.sort()
-
-labels = []
-for key in keys:
-    labels.append(label_dict[key])
-# print(labels)
-
-# # 假设 label 是你想要保存的变量
-# label = {'a': [1, 2, 3], 'b': (4, 5, 6)}  # 这里应该是你的变量，可以是任何 Python 对象
-
-output_filename = "labels.pkl"  # 要写入的文件名，推荐使用 .pkl 扩展名
-
-# 将变量保存到文件中
-with open(output_filename, "wb") as output_file:
-    pickle.dump(labels, output_file)
-print(f"已将变量保存到文件：{output_filename}")
-
-
-print("labels created:", len(labels))
-labels = {"category": labels}
-
-
-PATH = os.path.join(root_dir, "mir5k")
-index = [os.path.join(PATH, "im" + item + ".jpg") for item in keys]
-# print(index)
-output_filename = "index.pkl"  # 要写入的文件名，推荐使用 .pkl 扩展名
-
-# 将变量保存到文件中
-with open(output_filename, "wb") as output_file:
-    pickle.dump(index, output_file)
-print(f"已将变量保存到文件：{output_filename}")
-print("index created:", len(index))
-index= {"index": index}
-
-
-# captions_path = r"D:\CWNU\Papers\CMH+transformer\DCHMT-main\dataset\flickr25k\mirflickr25k\mirflickr\meta\tags"
-captions_path = "/root/autodl-tmp/DDLCH/dataset/or5k/ork/mir5k/meta/tags"
-captions_list = os.listdir(captions_path)
-captions_dict = {}
-for item in captions_list:
-    id_ = item.split(".")[0].replace("tags", "")
-    caption = ""
-    with open(os.path.join(captions_path, item), "r", encoding='utf-8') as f:
-        for word in f.readlines():
-            caption += word.strip() + " "
-    caption = caption.strip()
-    captions_dict.update({id_: caption})
-
-captions = []
-
-for item in keys:
-#     key = '7430'
-# try:
-#     value = captions_dict[key]
-#     print(f"The value for key {key} is: {value}")
-# except KeyError:
-#     print(f"Key {key} not found in captions_dict.")
-#     all_keys = list(captions_dict.keys())
-#     print(all_keys)
-
-
-    captions.append([captions_dict[item]])
-# print(captions)
-output_filename = "captions.pkl"  # 要写入的文件名，推荐使用 .pkl 扩展名
-# 将变量保存到文件中
-with open(output_filename, "wb") as output_file:
-    pickle.dump(captions, output_file)
-print(f"已将变量保存到文件：{output_filename}")
-print("captions created:", len(captions))
-captions = {"caption": captions}
-
-scio.savemat("/root/autodl-tmp/DDLCH/dataset/or5k/index.mat", index)
-scio.savemat("/root/autodl-tmp/DDLCH/dataset/or5k/caption.mat", captions)
-scio.savemat("/root/autodl-tmp/DDLCH/dataset/or5k/label.mat", labels)
-
-
-
-
+        return [line.strip() for line in f if line.strip() != ""]
+
+
+def read_caption(path: str) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return " ".join(word.strip() for word in f.readlines()).strip()
+
+
+def scan_annotations(annotation_dir: str, known: list, pool: ThreadPoolExecutor) -> dict:
+    # category name -> item keys, for the annotation files that are not in `known`
+    names = [name for name in sorted(os.listdir(annotation_dir))
+             if "_r1" not in name and "README" not in name and name not in known]
+    return dict(zip(names, pool.map(read_annotation, [os.path.join(annotation_dir, name) for name in names])))
+
+
+def load_manifest(output: str):
+    with open(os.path.join(output, "manifest.json"), "r") as f:
+        meta = json.load(f)
+    columns = {name: np.load(os.path.join(output, file)) for name, file in meta["columns"].items()}
+    labels = np.unpackbits(columns["labels"], axis=1, bitorder="little", count=meta["num_classes"]).astype(bool)
+    captions = [list(columns["captions"][a: b]) for a, b in zip(columns["caption_offsets"][:-1], columns["caption_offsets"][1:])]
+    return meta, list(columns["keys"]), list(columns["paths"]), captions, labels
+
+
+def save_manifest(output: str, classes: list, keys: list, paths: list, captions: list, labels: np.ndarray, image_root: str):
+    os.makedirs(output, exist_ok=True)
+    offsets = np.zeros(len(captions) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(item) for item in captions])
+    arrays = {
+        "keys": np.asarray(keys, dtype=str),
+        "paths": np.asarray(paths, dtype=str),
+        "captions": np.asarray([caption for item in captions for caption in item], dtype=str),
+        "caption_offsets": offsets,
+        "labels": np.packbits(labels, axis=1, bitorder="little"),
+    }
+    for name, file in COLUMNS.items():
+        # np.save adds .npy to a name without it
+        np.save(os.path.join(output, file + ".tmp.npy"), arrays[name])
+        os.replace(os.path.join(output, file + ".tmp.npy"), os.path.join(output, file))
+    meta = {"count": len(keys), "num_classes": len(classes), "classes": classes,
+            "image_root": os.path.relpath(image_root, output), "columns": COLUMNS}
+    # manifest.json is written last, the previous manifest stays valid until the build is complete
+    with open(os.path.join(output, "manifest.json.tmp"), "w") as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(output, "manifest.json.tmp"), os.path.join(output, "manifest.json"))
+
+
+def save_mat(output: str, paths: list, captions: list, labels: np.ndarray):
+    # the caption / index / label .mat files of dataset.dataloader.load_files
+    os.makedirs(output, exist_ok=True)
+    scio.savemat(os.path.join(output, "index.mat"), {"index": paths})
+    scio.savemat(os.path.join(output, "caption.mat"), {"caption": captions})
+    scio.savemat(os.path.join(output, "label.mat"), {"category": labels.astype(np.float64)})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--annotation-dir", type=str, default=os.path.join(ROOT_DIR, "ork_annotations"))
+    parser.add_argument("--caption-dir", type=str, default=os.path.join(ROOT_DIR, "ork/mir5k/meta/tags"))
+    parser.add_argument("--image-dir", type=str, default=os.path.join(ROOT_DIR, "ork/mir5k"))
+    parser.add_argument("--output", type=str, default=os.path.join(ROOT_DIR, "manifest"))
+    parser.add_argument("--update", action="store_true", help="add the new annotation files to the manifest in --output.")
+    parser.add_argument("--mat-dir", type=str, default=ROOT_DIR, help="directory of index.mat, caption.mat and label.mat with absolute paths.")
+    parser.add_argument("--no-mat", action="store_true", help="only write the manifest, no .mat files.")
+    parser.add_argument("--num-workers", type=int, default=16, help="threads reading annotation and caption files.")
+    args = parser.parse_args()
+
+    if args.update and os.path.exists(os.path.join(args.output, "manifest.json")):
+        meta, keys, paths, captions, labels = load_manifest(args.output)
+        classes = meta["classes"]
+    else:
+        classes, keys, paths, captions, labels = [], [], [], [], np.zeros((0, 0), dtype=bool)
+
+    with ThreadPoolExecutor(args.num_workers) as pool:
+        annotations = scan_annotations(args.annotation_dir, classes, pool)
+        print("class num: %d old, %d new" % (len(classes), len(annotations)))
+        row = {key: i for i, key in enumerate(keys)}
+        new_keys = sorted(set(key for items in annotations.values() for key in items) - set(row))
+        for key in new_keys:
+            row[key] = len(row)
+        new_captions = pool.map(read_caption, [os.path.join(args.caption_dir, "tags" + key + ".txt") for key in new_keys])
+        captions += [[caption] for caption in new_captions]
+
+    keys += new_keys
+    paths += ["im" + key + ".jpg" for key in new_keys]
+    # old items may belong to the new categories, so the new label columns cover every row
+    labels = np.pad(labels, ((0, len(new_keys)), (0, len(annotations))))
+    for c, items in enumerate(annotations.values(), start=len(classes)):
+        labels[[row[key] for key in items], c] = True
+    classes += list(annotations.keys())
+
+    save_manifest(args.output, classes, keys, paths, captions, labels, args.image_dir)
+    print("items: %d (%d new), classes: %d, written to %s" % (len(keys), len(new_keys), len(classes), args.output))
+    if not args.no_mat:
+        save_mat(args.mat_dir, [os.path.join(args.image_dir, path) for path in paths], captions, labels)
+        print("index.mat, caption.mat and label.mat written to %s" % args.mat_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import torch
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+
+
+def raw_collate(batch: list) -> list:
+    """
+    collate of BaseDataset items with raw uint8 images, images of different sizes stay a list of tensors.
+    """
+    images = [item[0] for item in batch]
+    if all(image.shape == images[0].shape for image in images):
+        images = torch.stack(images)
+    return [images] + list(default_collate([item[1:] for item in batch]))
+
+
+class BatchPreprocess(object):
+    """
+    the image transforms of BaseDataset on whole uint8 batches (batch, 3, H, W) on the model device.
+    crop=True is the train transform (bicubic resize of the shorter side, center crop), crop=False the eval
+    transform (bicubic resize to resolution x resolution). a list of images of different sizes (raw_collate)
+    is resized with one interpolation per size.
+    """
+
+    MEAN = (0.48145466, 0.4578275, 0.40821073)
+    STD = (0.26862954, 0.26130258, 0.27577711)
+
+    def __init__(self, resolution=224, device=0):
+        self.resolution = resolution
+        self.device = device
+        self.mean = torch.tensor(self.MEAN).view(1, 3, 1, 1).to(device)
+        self.std = torch.tensor(self.STD).view(1, 3, 1, 1).to(device)
+
+    def resize(self, images: torch.Tensor, crop=True) -> torch.Tensor:
+        height, width = images.shape[-2:]
+        if height == self.resolution and width == self.resolution:
+            return images
+        if not crop:
+            size = (self.resolution, self.resolution)
+            return F.interpolate(images, size=size, mode="bicubic", align_corners=False, antialias=True).clamp_(0, 1)
+        scale = self.resolution / min(height, width)
+        size = (max(self.resolution, round(height * scale)), max(self.resolution, round(width * scale)))
+        images = F.interpolate(images, size=size, mode="bicubic", align_corners=False, antialias=True).clamp_(0, 1)
+        top = (size[0] - self.resolution) // 2
+        left = (size[1] - self.resolution) // 2
+        return images[:, :, top: top + self.resolution, left: left + self.resolution]
+
+    def _prepare(self, images: torch.Tensor, crop: bool) -> torch.Tensor:
+        images = images.to(self.device, non_blocking=True).float().div_(255)
+        images = self.resize(images, crop)
+        return (images - self.mean) / self.std
+
+    def __call__(self, images, crop=True) -> torch.Tensor:
+        if isinstance(images, torch.Tensor):
+            return self._prepare(images, crop)
+        groups = {}
+        for i, image in enumerate(images):
+            groups.setdefault(tuple(image.shape), []).append(i)
+        out = torch.empty(len(images), 3, self.resolution, self.resolution, device=self.device)
+        for rows in groups.values():
+            out[torch.tensor(rows, device=self.device)] = self._prepare(torch.stack([images[i] for i in rows]), crop)
+        return out
@@ -0,0 +1,84 @@
+import json
+import time
+
+import torch
+from torch.utils.data import IterableDataset
+
+from .base import BaseDataset
+
+
+class RecordStream(IterableDataset):
+    """
+    records appended to a queue file by the producers, one json object per line:
+        {"id": 12, "image": "/path/to/image.jpg", "report": "text", "labels": [0, 3]}
+    the file is tailed from `offset` and yields batches (images, captions, labels, ids, offset), offset is the
+    byte position after the last record of the batch. a batch is emitted when it is full or when no new record
+    arrived and the oldest pending record has waited `max_wait` seconds. records are read only when the consumer
+    asks for the next batch, so memory stays bounded by the batches the DataLoader prefetches.
+    """
+
+    def __init__(self,
+                path: str,
+                loader: BaseDataset,
+                num_classes: int,
+                batch_size=128,
+                offset=0,
+                max_wait=5.0,
+                idle_timeout=0,
+                poll_interval=1.0):
+        self.path = path
+        self.loader = loader
+        self.num_classes = num_classes
+        self.batch_size = batch_size
+        self.offset = offset
+        self.max_wait = max_wait
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+
+    def _records(self):
+        # (record, offset after it), (None, offset) when the end of the file is reached
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            last_data = time.time()
+            while True:
+                position = f.tell()
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    # end of file or a line that is still being written
+                    f.seek(position)
+                    yield None, position
+                    if self.idle_timeout > 0 and time.time() - last_data > self.idle_timeout:
+                        return
+                    time.sleep(self.poll_interval)
+                    continue
+                last_data = time.time()
+                if line.strip() != b"":
+                    yield json.loads(line), f.tell()
+
+    def load(self, record: dict):
+        image = self.loader.load_image_file(record["image"])
+        caption = self.loader.encode_caption(record["report"])
+        label = torch.zeros(self.num_classes, dtype=torch.uint8)
+        label[torch.as_tensor(record["labels"], dtype=torch.long)] = 1
+        return image, caption, label, int(record["id"])
+
+    def collate(self, items: list, offset: int):
+        images, captions, labels, ids = zip(*items)
+        # raw images of different sizes stay a list, see dataset.preprocess.raw_collate
+        images = torch.stack(images) if all(image.shape == images[0].shape for image in images) else list(images)
+        return images, torch.stack(captions), torch.stack(labels), torch.tensor(ids, dtype=torch.long), offset
+
+    def __iter__(self):
+        pending = []
+        first_time = None
+        for record, offset in self._records():
+            if record is not None:
+                pending.append(self.load(record))
+                first_time = first_time if first_time is not None else time.time()
+            if len(pending) >= self.batch_size or \
+                    (record is None and len(pending) > 0 and time.time() - first_time >= self.max_wait):
+                yield self.collate(pending, offset)
+                pending = []
+                first_time = None
+        if len(pending) > 0:
+            yield self.collate(pending, offset)
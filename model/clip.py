@@ -4,6 +4,7 @@ import urllib
 import warnings
 from typing import Any, Union, List
 
+import numpy as np
 import torch
 from PIL import Image
 from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize
@@ -209,16 +210,17 @@ def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: b
 
     sot_token = _tokenizer.encoder["<|startoftext|>"]
     eot_token = _tokenizer.encoder["<|endoftext|>"]
-    all_tokens = [[sot_token] + _tokenizer.encode(text) + [eot_token] for text in texts]
-    result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
+    all_tokens = _tokenizer.encode_batch(texts)
+    result = np.zeros((len(all_tokens), context_length), dtype=np.int64)
 
     for i, tokens in enumerate(all_tokens):
-        if len(tokens) > context_length:
+        if len(tokens) + 2 > context_length:
             if truncate:
-                tokens = tokens[:context_length]
-                tokens[-1] = eot_token
+                tokens = tokens[:context_length - 2]
             else:
                 raise RuntimeError(f"Input {texts[i]} is too long for context length {context_length}")
-        result[i, :len(tokens)] = torch.tensor(tokens)
+        result[i, 0] = sot_token
+        result[i, 1: len(tokens) + 1] = tokens
+        result[i, len(tokens) + 1] = eot_token
 
-    return result
+    return torch.from_numpy(result)
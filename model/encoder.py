@@ -0,0 +1,157 @@
+import os
+from contextlib import nullcontext
+from typing import Union
+
+import numpy as np
+import torch
+from PIL import Image
+
+from model.hash_model import DDLCH
+from model.model import convert_weights, PRECISION_DTYPES
+from dataset.base import BaseDataset
+from utils import get_logger, PackedCodes, CodeStore
+
+
+class HashEncoder(object):
+    """
+    inference api of a trained DDLCH checkpoint. the model is loaded once, images and report texts are
+    encoded into the packed codes Trainer.get_code produces, and `search` ranks the items of the code
+    stores written by --code-store (test or --ingest) by hamming distance.
+        encoder = HashEncoder("./result/128-bit/model.pth", code_store="./result/codes")
+        codes = encoder.encode(texts=["polyp in the sigmoid colon"])
+        ids, distances = encoder.search(codes, target="img", k=10)
+    """
+
+    def __init__(self,
+                pretrained: str,
+                clip_path="./ViT-B-32.pt",
+                output_dim=128,
+                hash_layer="select",
+                max_words=64,
+                resolution=224,
+                precision="fp32",
+                code_store="",
+                dataset="or5k",
+                device=None,
+                search_block=65536,
+                save_dir="./result/serve"):
+        if not os.path.exists(pretrained):
+            raise FileNotFoundError("checkpoint %s doesn't exist." % pretrained)
+        self.device = torch.device(device if device is not None else ("cuda" if torch.cuda.is_available() else "cpu"))
+        self.output_dim = output_dim
+        self.hash_layer = hash_layer
+        self.precision = precision
+        os.makedirs(save_dir, exist_ok=True)
+        self.logger = get_logger(os.path.join(save_dir, "serve.log"))
+
+        self.model = DDLCH(outputDim=output_dim, clipPath=clip_path, saveDir=save_dir, logger=self.logger,
+                           is_train=False, linear=hash_layer == "linear").to(self.device)
+        self.model.load_state_dict(torch.load(pretrained, map_location=self.device))
+        self.model.float()
+        if precision in PRECISION_DTYPES:
+            convert_weights(self.model.clip, PRECISION_DTYPES[precision])
+        self.model.eval()
+        self.model.clip.eval()
+        # tokenizer and image transforms of the evaluation loaders
+        self.loader = BaseDataset([], [], [], is_train=False, maxWords=max_words, imageResolution=resolution)
+
+        self.code_store = code_store
+        self.dataset = dataset
+        # store rows scanned at once by search, a scan holds num_query x search_block distances
+        self.search_block = search_block
+        self.stores = {}
+        self._store_mtime = {}
+        self._store_codes = {}
+        if code_store != "":
+            self.load_stores()
+
+    def autocast(self):
+        if self.precision not in PRECISION_DTYPES:
+            return nullcontext()
+        return torch.autocast(self.device.type, dtype=PRECISION_DTYPES[self.precision])
+
+    def load_image(self, image: Union[str, Image.Image]) -> torch.Tensor:
+        """
+        :param image: image path or PIL image
+        :return: normalized (3, resolution, resolution) tensor
+        """
+        if isinstance(image, Image.Image):
+            return self.loader.transform_image(image.convert("RGB"))
+        return self.loader.load_image_file(image)
+
+    def load_text(self, text: str) -> torch.Tensor:
+        """
+        :return: (max_words,) token ids
+        """
+        return self.loader.encode_caption(text)
+
+    def make_hash_code(self, code: torch.Tensor) -> PackedCodes:
+        # the same sign codes as Trainer.get_code, select: (batch, bit, 2) softmax, linear: (batch, bit) logits
+        if self.hash_layer == "select":
+            code = torch.argmax(code, dim=-1) * 2 - 1
+        return PackedCodes.from_codes(code)
+
+    def encode_image(self, images: torch.Tensor) -> PackedCodes:
+        """
+        :param images: (batch, 3, resolution, resolution) tensor of load_image outputs
+        """
+        with torch.no_grad(), self.autocast():
+            code = self.model.encode_image(images.to(self.device, non_blocking=True))
+        return self.make_hash_code(code)
+
+    def encode_text(self, texts: torch.Tensor) -> PackedCodes:
+        """
+        :param texts: (batch, max_words) tensor of load_text outputs
+        """
+        with torch.no_grad(), self.autocast():
+            code = self.model.encode_text(texts.to(self.device, non_blocking=True))
+        return self.make_hash_code(code)
+
+    def encode(self, images=None, texts=None) -> Union[PackedCodes, tuple]:
+        """
+        encode image paths / PIL images and report texts in one batch per modality.
+        :return: the codes of the given modality, (image codes, text codes) if both are given
+        """
+        result = []
+        if images is not None:
+            result.append(self.encode_image(torch.stack([self.load_image(image) for image in images])))
+        if texts is not None:
+            result.append(self.encode_text(torch.stack([self.load_text(text) for text in texts])))
+        if len(result) == 0:
+            raise ValueError("images or texts must be given.")
+        return result[0] if len(result) == 1 else tuple(result)
+
+    def store_path(self, name: str) -> str:
+        # the file name of Trainer.code_store_path
+        return os.path.join(self.code_store, str(self.output_dim) + "-ours-" + self.dataset + "-" + name + ".codes")
+
+    def load_stores(self):
+        """
+        open the img / txt code stores, a store is opened again when its file changed (e.g. by --ingest).
+        """
+        for name in ["img", "txt"]:
+            path = self.store_path(name)
+            if not os.path.exists(path):
+                continue
+            mtime = os.path.getmtime(path)
+            if self._store_mtime.get(name) == mtime:
+                continue
+            store = CodeStore(path)
+            if store.bit != self.output_dim:
+                raise ValueError("code store %s holds %d-bit codes, but output dim is %d." % (path, store.bit, self.output_dim))
+            self.stores[name] = store
+            self._store_codes[name] = store.codes()
+            self._store_mtime[name] = mtime
+            self.logger.info(f"code store {path}: {len(store)} codes.")
+
+    def search(self, codes: PackedCodes, target="img", k=10) -> tuple:
+        """
+        k nearest stored items of every query code, ties are broken by the store order.
+        :param target: store to search, img or txt
+        :return: (ids, distances), int64 / int32 arrays with shape (num_query, min(k, store size))
+        """
+        self.load_stores()
+        if target not in self.stores:
+            raise KeyError("there is no %s code store in %s." % (target, self.code_store))
+        rows, dist = codes.topk(self._store_codes[target], k, block_size=self.search_block)
+        return np.asarray(self.stores[target].ids)[rows], dist
@@ -37,6 +37,11 @@ class LinearHash(nn.Module):
 
 
 class HashLayer(nn.Module):
+    """
+    select mechanism hash head, every bit has its own 2-way linear classifier on a shared embedding.
+    the classifiers of all bits are stored as one (outputDim, 2, LINEAR_EMBED) weight and computed with a
+    single batched matmul, checkpoints of the old per-bit layout (hash_list.{i}.weight) are converted on load.
+    """
 
     LINEAR_EMBED = 128
     SIGMOID_ALPH = 10
@@ -45,18 +50,30 @@ class HashLayer(nn.Module):
         super(HashLayer, self).__init__()
         self.fc = nn.Linear(inputDim, self.LINEAR_EMBED)
         self.fc.apply(weights_init_kaiming)
-        self.hash_list = nn.ModuleList([nn.Linear(self.LINEAR_EMBED, 2) for _ in range(outputDim)])
-        for item in self.hash_list:
-            item.apply(weights_init_kaiming)
+        self.weight = nn.Parameter(torch.empty(outputDim, 2, self.LINEAR_EMBED))
+        self.bias = nn.Parameter(torch.zeros(outputDim, 2))
+        with torch.no_grad():
+            # same init as one nn.Linear(LINEAR_EMBED, 2) per bit
+            for item in self.weight:
+                nn.init.kaiming_uniform_(item, mode='fan_out')
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if prefix + "hash_list.0.weight" in state_dict:
+            bit = self.weight.shape[0]
+            state_dict[prefix + "weight"] = torch.stack([state_dict.pop(prefix + "hash_list.%d.weight" % i) for i in range(bit)])
+            state_dict[prefix + "bias"] = torch.stack([state_dict.pop(prefix + "hash_list.%d.bias" % i) for i in range(bit)])
+        super(HashLayer, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
     
     def forward(self, data):
-        
+        """
+        :return: softmax of every bit with shape (batch, outputDim, 2)
+        """
         embed = self.fc(data)
         embed = torch.relu(embed)
 
-        softmax_list = [torch.softmax(item(embed), dim=-1) for item in self.hash_list]
+        logits = torch.einsum("bd,kcd->bkc", embed, self.weight) + self.bias
 
-        return softmax_list
+        return torch.softmax(logits, dim=-1)
 
 class HashLayer_easy_logic(nn.Module):
 
@@ -102,6 +119,8 @@ class DDLCH(nn.Module):
         # self.freezen()
         self.image_hash =  LinearHash(inputDim=embedDim, outputDim=outputDim) if linear else HashLayer(inputDim=embedDim, outputDim=outputDim)
         self.text_hash = LinearHash(inputDim=embedDim, outputDim=outputDim) if linear else HashLayer(inputDim=embedDim, outputDim=outputDim)
+        # inputs are cached clip embeddings instead of images and tokens, see dataset/feature_cache.py
+        self.use_features = False
         # print(self.image_hash)
         # print(self.text_hash)
 
@@ -135,8 +154,10 @@ class DDLCH(nn.Module):
 
     def encode_image(self, image):
 
-        image_embed = self.clip.encode_image(image)
-        image_embed = self.image_hash(image_embed)
+        image_embed = image if self.use_features else self.clip.encode_image(image)
+        # the hash layer runs in fp32 under autocast and on a low precision backbone
+        with torch.autocast(image_embed.device.type, enabled=False):
+            image_embed = self.image_hash(image_embed.float())
 
         return image_embed
     
@@ -153,8 +174,9 @@ class DDLCH(nn.Module):
     
     def encode_text(self, text):
 
-        text_embed = self.clip.encode_text(text)
-        text_embed = self.text_hash(text_embed)
+        text_embed = text if self.use_features else self.clip.encode_text(text)
+        with torch.autocast(text_embed.device.type, enabled=False):
+            text_embed = self.text_hash(text_embed.float())
 
         return text_embed
 
@@ -183,9 +183,10 @@ class ResidualAttentionBlock(nn.Module):
         # return self.attn(x, x, x, need_weights=False, attn_mask=self.attn_mask)[0]
         attn_mask_ = self.attn_mask
         if self.attn_mask is not None and hasattr(self.attn_mask, '__call__'):
-            attn_mask_ = self.attn_mask(x.size(0))   # LND
+            attn_mask_ = self.attn_mask(x.size(0), dtype=x.dtype, device=x.device)   # LND
+        elif attn_mask_ is not None:
+            attn_mask_ = attn_mask_.to(dtype=x.dtype, device=x.device)
 
-        attn_mask_ = attn_mask_.to(dtype=x.dtype, device=x.device) if attn_mask_ is not None else None
         return self.attn(x, x, x, need_weights=False, attn_mask=attn_mask_)[0]
 
     def forward(self, x: torch.Tensor):
@@ -269,6 +270,8 @@ class CLIP(nn.Module):
         super().__init__()
 
         self.context_length = context_length
+        # causal masks of build_attention_mask, keyed by (length, dtype, device)
+        self._attention_masks = {}
 
         if isinstance(vision_layers, (tuple, list)):
             vision_heads = vision_width * 32 // 64
@@ -336,12 +339,16 @@ class CLIP(nn.Module):
         if self.text_projection is not None:
             nn.init.normal_(self.text_projection, std=self.transformer.width ** -0.5)
 
-    def build_attention_mask(self, context_length):
+    def build_attention_mask(self, context_length, dtype=torch.float32, device=None):
         # lazily create causal attention mask, with full attention between the vision tokens
         # pytorch uses additive attention mask; fill with -inf
-        mask = torch.empty(context_length, context_length)
-        mask.fill_(float("-inf"))
-        mask.triu_(1)  # zero out the lower diagonal
+        # the mask of a length / dtype / device is built once and shared by every text block and forward
+        key = (context_length, dtype, str(device))
+        mask = self._attention_masks.get(key)
+        if mask is None:
+            mask = torch.full((context_length, context_length), float("-inf"), dtype=dtype, device=device)
+            mask.triu_(1)  # zero out the lower diagonal
+            self._attention_masks[key] = mask
         return mask
 
     @property
@@ -352,6 +359,9 @@ class CLIP(nn.Module):
         return self.visual(image.type(self.dtype))
 
     def encode_text(self, text):
+        # with the causal mask the padding after the eot token can not change the eot feature, so the batch is
+        # cut after its longest sequence and the transformer and its mask only cover that length
+        text = text[:, :int(text.argmax(dim=-1).max()) + 1]
         x = self.token_embedding(text).type(self.dtype)  # [batch_size, n_ctx, d_model]
 
         x = x + self.positional_embedding[:x.size(1), :].type(self.dtype)
@@ -383,26 +393,30 @@ class CLIP(nn.Module):
         return logits_per_image, logits_per_text
 
 
-def convert_weights(model: nn.Module):
-    """Convert applicable model parameters to fp16"""
+# autocast / weight dtypes of --precision, fp32 has no entry
+PRECISION_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def convert_weights(model: nn.Module, dtype=torch.float16):
+    """Convert applicable model parameters to fp16 (or another low precision dtype, e.g. bf16), LayerNorm stays fp32"""
 
     def _convert_weights_to_fp16(l):
         if isinstance(l, (nn.Conv1d, nn.Conv2d, nn.Linear)):
-            l.weight.data = l.weight.data.half()
+            l.weight.data = l.weight.data.to(dtype)
             if l.bias is not None:
-                l.bias.data = l.bias.data.half()
+                l.bias.data = l.bias.data.to(dtype)
 
         if isinstance(l, nn.MultiheadAttention):
             for attr in [*[f"{s}_proj_weight" for s in ["in", "q", "k", "v"]], "in_proj_bias", "bias_k", "bias_v"]:
                 tensor = getattr(l, attr)
                 if tensor is not None:
-                    tensor.data = tensor.data.half()
+                    tensor.data = tensor.data.to(dtype)
 
         for name in ["text_projection", "proj"]:
             if hasattr(l, name):
                 attr = getattr(l, name)
                 if attr is not None:
-                    attr.data = attr.data.half()
+                    attr.data = attr.data.to(dtype)
 
     model.apply(_convert_weights_to_fp16)
 
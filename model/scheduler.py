@@ -0,0 +1,156 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+
+from model.encoder import HashEncoder
+from utils import PackedCodes
+
+
+class Query(object):
+    """
+    one image or text query, `data` is the output of HashEncoder.load_image / load_text.
+    target is the store to search (img or txt), None only encodes the query.
+    """
+
+    def __init__(self, modality: str, data: torch.Tensor, target=None, k=10):
+        self.modality = modality
+        self.data = data
+        self.target = target
+        self.k = k
+        self.future = Future()
+        self.submit_time = 0.0
+
+
+class SchedulerStats(object):
+    """
+    queue time (submit to the start of its batch) and compute time (encoding + search of its batch) of the
+    queries, and the batch sizes. times are in ms.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.num_queries = 0
+            self.num_batches = 0
+            self.queue_time = 0.0
+            self.max_queue_time = 0.0
+            self.encode_time = 0.0
+            self.search_time = 0.0
+            self.max_batch_size = 0
+
+    def add(self, queue_times: list, encode_time: float, search_time: float):
+        with self.lock:
+            self.num_queries += len(queue_times)
+            self.num_batches += 1
+            self.queue_time += sum(queue_times)
+            self.max_queue_time = max([self.max_queue_time] + queue_times)
+            self.encode_time += encode_time
+            self.search_time += search_time
+            self.max_batch_size = max(self.max_batch_size, len(queue_times))
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            queries, batches = max(self.num_queries, 1), max(self.num_batches, 1)
+            return {
+                "queries": self.num_queries,
+                "batches": self.num_batches,
+                "mean_batch_size": self.num_queries / batches,
+                "max_batch_size": self.max_batch_size,
+                "mean_queue_ms": self.queue_time / queries,
+                "max_queue_ms": self.max_queue_time,
+                "mean_encode_ms": self.encode_time / batches,
+                "mean_search_ms": self.search_time / batches,
+                "mean_compute_ms": (self.encode_time + self.search_time) / batches,
+            }
+
+
+class QueryScheduler(object):
+    """
+    micro-batching of concurrent queries. one thread runs the model: it waits for a query, collects the queries
+    that arrive within `max_wait` seconds (at most `max_batch`), encodes every modality in one forward and
+    searches every target store with one blocked hamming scan. the callers only decode / tokenize their
+    queries and wait on the futures, so a query trades up to max_wait of latency for the batch throughput.
+        scheduler = QueryScheduler(encoder, max_batch=64, max_wait=0.005)
+        code, ids, distances = scheduler.submit(Query("text", encoder.load_text("..."), target="img")).result()
+    """
+
+    def __init__(self, encoder: HashEncoder, max_batch=64, max_wait=0.005, log_interval=60.0):
+        self.encoder = encoder
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.log_interval = log_interval
+        self.stats = SchedulerStats()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, query: Query) -> Future:
+        """
+        :return: future of (code, ids, distances), ids and distances are None if the query has no target
+        """
+        query.submit_time = time.perf_counter()
+        self.queue.put(query)
+        return query.future
+
+    def _collect(self) -> list:
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                # queries that are already queued join the batch even after the deadline
+                batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        last_log = time.perf_counter()
+        while True:
+            batch = self._collect()
+            try:
+                self._process(batch)
+            except Exception as e:
+                for query in batch:
+                    if not query.future.done():
+                        query.future.set_exception(e)
+            if self.log_interval > 0 and time.perf_counter() - last_log > self.log_interval:
+                self.encoder.logger.info(f"scheduler: {self.stats.snapshot()}")
+                last_log = time.perf_counter()
+
+    def _process(self, batch: list):
+        start = time.perf_counter()
+        queue_times = [(start - query.submit_time) * 1000 for query in batch]
+        bit = self.encoder.output_dim
+        codes = {}
+        for modality, encode in [("image", self.encoder.encode_image), ("text", self.encoder.encode_text)]:
+            queries = [query for query in batch if query.modality == modality]
+            if len(queries) > 0:
+                words = encode(torch.stack([query.data for query in queries])).words
+                for query, word in zip(queries, words):
+                    codes[id(query)] = PackedCodes(word[None], bit)
+        encoded = time.perf_counter()
+
+        for target in set(query.target for query in batch if query.target is not None):
+            queries = [query for query in batch if query.target == target]
+            q_codes = PackedCodes(np.concatenate([codes[id(query)].words for query in queries]), bit)
+            try:
+                ids, dist = self.encoder.search(q_codes, target=target, k=max(query.k for query in queries))
+            except KeyError as e:
+                for query in queries:
+                    query.future.set_exception(e)
+                continue
+            for i, query in enumerate(queries):
+                query.future.set_result((codes[id(query)], ids[i, :query.k], dist[i, :query.k]))
+        self.stats.add(queue_times, (encoded - start) * 1000, (time.perf_counter() - encoded) * 1000)
+
+        for query in batch:
+            if not query.future.done():
+                query.future.set_result((codes[id(query)], None, None))
@@ -1,6 +1,7 @@
 import gzip
 import html
 import os
+from collections import OrderedDict
 from functools import lru_cache
 
 import ftfy
@@ -60,7 +61,7 @@ def whitespace_clean(text):
 
 
 class SimpleTokenizer(object):
-    def __init__(self, bpe_path: str = default_bpe()):
+    def __init__(self, bpe_path: str = default_bpe(), cache_size: int = 2 ** 16):
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
         merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
@@ -74,11 +75,17 @@ class SimpleTokenizer(object):
         self.encoder = dict(zip(vocab, range(len(vocab))))
         self.decoder = {v: k for k, v in self.encoder.items()}
         self.bpe_ranks = dict(zip(merges, range(len(merges))))
-        self.cache = {'<|startoftext|>': '<|startoftext|>', '<|endoftext|>': '<|endoftext|>'}
+        self.special_tokens = {'<|startoftext|>': '<|startoftext|>', '<|endoftext|>': '<|endoftext|>'}
+        # bpe results of the most recently used words, bounded so bulk tokenization does not grow it without limit
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
         self.pat = re.compile(r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""", re.IGNORECASE)
 
     def bpe(self, token):
+        if token in self.special_tokens:
+            return self.special_tokens[token]
         if token in self.cache:
+            self.cache.move_to_end(token)
             return self.cache[token]
         word = tuple(token[:-1]) + ( token[-1] + '</w>',)
         pairs = get_pairs(word)
@@ -116,6 +123,8 @@ class SimpleTokenizer(object):
                 pairs = get_pairs(word)
         word = ' '.join(word)
         self.cache[token] = word
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
         return word
 
     def encode(self, text):
@@ -126,6 +135,22 @@ class SimpleTokenizer(object):
             bpe_tokens.extend(self.encoder[bpe_token] for bpe_token in self.bpe(token).split(' '))
         return bpe_tokens
 
+    def encode_batch(self, texts):
+        """
+        encode a list of texts, every distinct word of the batch goes through bpe once.
+        :return: a list with the bpe ids of every text, same as encode
+        """
+        words = []
+        for text in texts:
+            text = whitespace_clean(basic_clean(text)).lower()
+            words.append([''.join(self.byte_encoder[b] for b in token.encode('utf-8')) for token in re.findall(self.pat, text)])
+        ids = {}
+        for text_words in words:
+            for word in text_words:
+                if word not in ids:
+                    ids[word] = [self.encoder[bpe_token] for bpe_token in self.bpe(word).split(' ')]
+        return [[i for word in text_words for i in ids[word]] for text_words in words]
+
     def decode(self, tokens):
         text = ''.join([self.decoder[token] for token in tokens])
         text = bytearray([self.byte_decoder[c] for c in text]).decode('utf-8', errors="replace").replace('</w>', ' ')
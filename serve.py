@@ -0,0 +1,142 @@
+"""
+http server of model.encoder.HashEncoder for the search ui, on a tcp port or a unix socket:
+
+    python serve.py --pretrained ./result/128-bit/model.pth --code-store ./result/codes --port 8000
+    python serve.py --pretrained ./result/128-bit/model.pth --code-store ./result/codes --unix-socket /tmp/ddlch.sock
+
+POST /encode  {"queries": [{"text": "..."}, {"image": "relative/path/to/image.jpg"}, {"image_base64": "..."}]}
+           -> {"codes": ["<hex of the little-endian uint64 words>", ...]}
+POST /search  {"queries": [...], "k": 10, "target": "img"}
+           -> {"results": [{"code": "...", "ids": [...], "distances": [...]}, ...]}
+GET  /health  -> {"bit": 128, "stores": {"img": 5000, "txt": 5000}}
+GET  /metrics -> queue time vs compute time of the queries and the batch sizes, see model.scheduler.SchedulerStats
+
+image paths are relative to --serve-image-root, without it only image_base64 queries are accepted.
+the target store defaults to the other modality of the query (text -> img, image -> txt). queries of
+concurrent requests are micro-batched by model.scheduler.QueryScheduler and encoded / searched together.
+"""
+import os
+import io
+import json
+import base64
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+from model.encoder import HashEncoder
+from model.scheduler import Query, QueryScheduler
+from utils import get_args, PackedCodes
+
+
+def code_to_hex(codes: PackedCodes) -> str:
+    return codes.words[0].astype("<u8").tobytes().hex()
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    scheduler: QueryScheduler = None
+    image_root = ""
+
+    def address_string(self):
+        # the client address of a unix socket is an empty string
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def send_json(self, code: int, data: dict):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def image_path(self, path: str) -> str:
+        # the clients only read the images under image_root, the errors don't tell which paths exist
+        if self.image_root == "":
+            raise ValueError("image paths are disabled, send image_base64.")
+        root = os.path.realpath(self.image_root)
+        path = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+            raise ValueError("image is not readable.")
+        return path
+
+    def load_query(self, item: dict, search: bool, target, k: int) -> Query:
+        encoder = self.scheduler.encoder
+        if "text" in item:
+            modality, data = "text", encoder.load_text(item["text"])
+        elif "image" in item:
+            try:
+                modality, data = "image", encoder.load_image(self.image_path(item["image"]))
+            except OSError:
+                raise ValueError("image is not readable.")
+        elif "image_base64" in item:
+            modality, data = "image", encoder.load_image(Image.open(io.BytesIO(base64.b64decode(item["image_base64"]))))
+        else:
+            raise ValueError("a query must have text, image or image_base64.")
+        if search and target is None:
+            target = "img" if modality == "text" else "txt"
+        return Query(modality, data, target if search else None, k)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            return self.send_json(200, self.scheduler.stats.snapshot())
+        if self.path != "/health":
+            return self.send_json(404, {"error": "unknown path %s" % self.path})
+        encoder = self.scheduler.encoder
+        self.send_json(200, {"bit": encoder.output_dim, "stores": {name: len(store) for name, store in encoder.stores.items()}})
+
+    def do_POST(self):
+        if self.path not in ["/encode", "/search"]:
+            return self.send_json(404, {"error": "unknown path %s" % self.path})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            search = self.path == "/search"
+            queries = [self.load_query(item, search, request.get("target"), int(request.get("k", 10))) for item in request["queries"]]
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            return self.send_json(400, {"error": str(e)})
+
+        try:
+            # submit every query before waiting, so the queries of one request share a batch
+            futures = [self.scheduler.submit(query) for query in queries]
+            results = [future.result() for future in futures]
+        except KeyError as e:
+            return self.send_json(404, {"error": str(e)})
+        except Exception as e:
+            return self.send_json(500, {"error": str(e)})
+        if not search:
+            return self.send_json(200, {"codes": [code_to_hex(code) for code, _, _ in results]})
+        self.send_json(200, {"results": [{"code": code_to_hex(code), "ids": ids.tolist(), "distances": dist.tolist()}
+                                         for code, ids, dist in results]})
+
+
+class HTTPServer(ThreadingHTTPServer):
+    # the default listen backlog of 5 resets connections of a burst of concurrent queries
+    request_queue_size = 256
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+def main():
+    args = get_args()
+    encoder = HashEncoder(args.pretrained, clip_path=args.clip_path, output_dim=args.output_dim, hash_layer=args.hash_layer,
+                          max_words=args.max_words, resolution=args.resolution, precision=args.precision,
+                          code_store=args.code_store, dataset=args.dataset, search_block=args.serve_search_block, save_dir=args.save_dir)
+    Handler.image_root = args.serve_image_root
+    Handler.scheduler = QueryScheduler(encoder, max_batch=args.serve_max_batch, max_wait=args.serve_max_wait / 1000,
+                                       log_interval=args.serve_log_interval)
+    if args.unix_socket != "":
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = UnixHTTPServer(args.unix_socket, Handler)
+        encoder.logger.info(f"serving on unix socket {args.unix_socket}")
+    else:
+        server = HTTPServer((args.host, args.port), Handler)
+        encoder.logger.info(f"serving on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,10 @@
 import os
+from contextlib import nullcontext
 from tqdm import tqdm
 import torch
 
 from torch import distributed as dist
+from model.model import PRECISION_DTYPES
 from utils import get_logger, get_summary_writer
 
 
@@ -17,6 +19,8 @@ class TrainBase(object):
         self._init_writer()
         self.logger.info(self.args)
         self.rank = rank
+        # batch image preprocessing on the device, None when the loader returns normalized images
+        self.preprocess = None
 
         self._init_dataset()
         self._init_model()
@@ -54,17 +58,31 @@ class TrainBase(object):
         elif mode == "valid":
             self.model.eval()
     
+    def autocast(self):
+        # mixed precision context of --precision for the model forward, nothing for fp32
+        if self.args.precision not in PRECISION_DTYPES:
+            return nullcontext()
+        device_type = next(self.model.parameters()).device.type
+        return torch.autocast(device_type, dtype=PRECISION_DTYPES[self.args.precision])
+
+    def image_to_device(self, image: torch.Tensor, crop=False) -> torch.Tensor:
+        # crop: the train transform of BatchPreprocess, else the eval transform
+        if self.preprocess is not None:
+            return self.preprocess(image, crop=crop)
+        return image.to(self.rank, non_blocking=True)
+
     def get_code(self, data_loader, length: int):
 
         img_buffer = torch.empty(length, self.args.output_dim, dtype=torch.float).to(self.rank)
         text_buffer = torch.empty(length, self.args.output_dim, dtype=torch.float).to(self.rank)
 
         for image, text, label, index in tqdm(data_loader):
-            image = image.to(self.rank, non_blocking=True)
+            image = self.image_to_device(image)
             text = text.to(self.rank, non_blocking=True)
             index = index.numpy()
-            image_hash = self.model.encode_image(image)
-            text_hash = self.model.encode_text(text)
+            with self.autocast():
+                image_hash = self.model.encode_image(image)
+                text_hash = self.model.encode_text(text)
 
             img_buffer[index, :] = image_hash.data
             text_buffer[index, :] = text_hash.data
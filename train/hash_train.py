@@ -4,19 +4,25 @@ import os
 from tqdm import tqdm
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 import scipy.io as scio
 import numpy as np
 
 
 from .base import TrainBase
 from model.optimization import BertAdam
-from utils import get_args, calc_neighbor, cosine_similarity, euclidean_similarity
-from utils.calc_utils import calc_map_k_matrix as calc_map_k
+from utils import get_args, calc_neighbor, cosine_similarity, euclidean_similarity, PackedCodes, MultiIndexHashing, CodeStore
+from utils.evaluator import RetrievalEvaluator
 from dataset.dataloader import dataloader
+from dataset.feature_cache import FeatureDataset, build_features, feature_fingerprint, meta_path
+from dataset.preprocess import BatchPreprocess, raw_collate
+from dataset.stream import RecordStream
+from dataset.bucket_sampler import LengthBucketSampler
+from dataset.base import BaseDataset
 
 from train.mas import MASLoss
 from model.model import Bottleneck as model
+from model.model import convert_weights, PRECISION_DTYPES
 
 
 
@@ -28,6 +34,9 @@ class Trainer(TrainBase):
         args = get_args()
         super(Trainer, self).__init__(args, rank)
         self.logger.info("dataset len: {}".format(len(self.train_loader.dataset)))
+        # --ingest encodes raw records with the whole model, it does not read the cached embeddings
+        if self.args.feature_cache != "" and self.args.ingest == "":
+            self.init_feature_cache()
         self.run()
 
     def _init_model(self):
@@ -45,6 +54,13 @@ class Trainer(TrainBase):
             self.model.load_state_dict(torch.load(self.args.pretrained, map_location=f"cuda:{self.rank}"))
         
         self.model.float()
+        if not self.args.is_train and self.args.precision in PRECISION_DTYPES:
+            # inference only: the clip backbone runs purely in half / bf16, LayerNorm and the hash layers stay fp32
+            convert_weights(self.model.clip, PRECISION_DTYPES[self.args.precision])
+        # loss scaling for fp16 training only, torch.amp.GradScaler needs torch >= 2.3, older versions have the cuda one
+        self.scaler = None
+        if self.args.precision == "fp16" and torch.cuda.is_available():
+            self.scaler = torch.amp.GradScaler("cuda") if hasattr(torch.amp, "GradScaler") else torch.cuda.amp.GradScaler()
         self.optimizer = BertAdam([
                     {'params': self.model.clip.parameters(), 'lr': self.args.clip_lr},
                     {'params': self.model.image_hash.parameters(), 'lr': self.args.lr},
@@ -60,6 +76,8 @@ class Trainer(TrainBase):
         self.args.index_file = os.path.join("./dataset", self.args.dataset, self.args.index_file)
         self.args.caption_file = os.path.join("./dataset", self.args.dataset, self.args.caption_file)
         self.args.label_file = os.path.join("./dataset", self.args.dataset, self.args.label_file)
+        if self.args.manifest != "":
+            self.args.manifest = os.path.join("./dataset", self.args.dataset, self.args.manifest)
         train_data, query_data, retrieval_data = dataloader(captionFile=self.args.caption_file, 
                                         indexFile=self.args.index_file, 
                                         labelFile=self.args.label_file, 
@@ -67,35 +85,87 @@ class Trainer(TrainBase):
                                         imageResolution=self.args.resolution,
                                         query_num=self.args.query_num,
                                         train_num=self.args.train_num,
-                                        seed=self.args.seed)
+                                        seed=self.args.seed,
+                                        captionCache=self.args.caption_cache,
+                                        imageShards=self.args.image_shards,
+                                        rawImages=self.args.preprocess == "device",
+                                        manifest=self.args.manifest)
+        # raw images of different sizes are batched as lists, BatchPreprocess resizes them on the device
+        self.collate_fn = raw_collate if self.args.preprocess == "device" else None
+        if self.args.preprocess == "device":
+            self.preprocess = BatchPreprocess(resolution=self.args.resolution, device=self.rank)
         self.train_labels = train_data.get_all_label()
         self.query_labels = query_data.get_all_label()
         self.retrieval_labels = retrieval_data.get_all_label()
         self.args.retrieval_num = len(self.retrieval_labels)
         self.logger.info(f"query shape: {self.query_labels.shape}")
         self.logger.info(f"retrieval shape: {self.retrieval_labels.shape}")
-        self.train_loader = DataLoader(
-                dataset=train_data,
-                batch_size=self.args.batch_size,
+        memory_limit = self.args.eval_memory_limit * 2 ** 20 if self.args.eval_memory_limit > 0 else 512 * 2 ** 20
+        self.evaluator = RetrievalEvaluator(self.query_labels, self.retrieval_labels, memory_limit=memory_limit)
+        self.train_loader = self.make_loader(train_data, is_train=True)
+        self.query_loader = self.make_loader(query_data)
+        self.retrieval_loader = self.make_loader(retrieval_data)
+
+    def make_loader(self, dataset, is_train=False):
+        if self.args.length_bucket <= 0:
+            return DataLoader(
+                    dataset=dataset,
+                    batch_size=self.args.batch_size,
+                    num_workers=self.args.num_workers,
+                    pin_memory=True,
+                    shuffle=True,
+                    collate_fn=self.collate_fn
+                )
+        # batches of similar caption length, the text encoder drops the padding of every batch. the codes of
+        # query / retrieval are stored by index, so their items are simply sorted by length
+        sampler = LengthBucketSampler(dataset.text_lengths(), self.args.batch_size, shuffle=is_train,
+                                      bucket_size=self.args.length_bucket, seed=self.args.seed)
+        return DataLoader(
+                dataset=dataset,
+                batch_sampler=sampler,
                 num_workers=self.args.num_workers,
                 pin_memory=True,
-                shuffle=True
-            )
-        self.query_loader = DataLoader(
-                dataset=query_data,
-                batch_size=self.args.batch_size,
-                num_workers=self.args.num_workers,
-                pin_memory=True,
-                shuffle=True
-            )
-        self.retrieval_loader = DataLoader(
-                dataset=retrieval_data,
-                batch_size=self.args.batch_size,
-                num_workers=self.args.num_workers,
-                pin_memory=True,
-                shuffle=True
+                collate_fn=self.collate_fn
             )
 
+    def init_feature_cache(self):
+        """
+        train and evaluate the hash layers from cached clip embeddings, the backbone runs once to build
+        the missing caches and is frozen afterwards.
+        """
+        os.makedirs(self.args.feature_cache, exist_ok=True)
+        loaders = []
+        for name, loader, labels in [("train", self.train_loader, self.train_labels),
+                                     ("query", self.query_loader, self.query_labels),
+                                     ("retrieval", self.retrieval_loader, self.retrieval_labels)]:
+            prefix = os.path.join(self.args.feature_cache, self.args.dataset + "-" + name)
+            # the split (--seed, --query-num, --train-num), the backbone and its input settings key the cache
+            fingerprint = feature_fingerprint(loader.dataset.ids, files=(self.args.clip_path, self.args.pretrained),
+                                              max_words=self.args.max_words, resolution=self.args.resolution)
+            if not FeatureDataset.exists(prefix, fingerprint):
+                if os.path.exists(meta_path(prefix)):
+                    self.logger.warning(f"{name} feature cache {prefix} was built for other items or another model, rebuild it.")
+                self.logger.info(f"build {name} feature cache {prefix}.")
+                self.model.clip.eval()
+                build_features(self.model.clip, loader.dataset, prefix, batch_size=self.args.batch_size,
+                               num_workers=self.args.num_workers, device=self.rank, preprocess=self.preprocess,
+                               fingerprint=fingerprint)
+            dataset = FeatureDataset(prefix, labels, ids=loader.dataset.ids)
+            loaders.append(DataLoader(
+                    dataset=dataset,
+                    batch_size=self.args.batch_size,
+                    num_workers=self.args.num_workers,
+                    pin_memory=True,
+                    shuffle=True
+                ))
+        self.train_loader, self.query_loader, self.retrieval_loader = loaders
+        # the cached features are model input already
+        self.preprocess = None
+        self.model.use_features = True
+        for param in self.model.clip.parameters():
+            param.requires_grad = False
+        self.logger.info(f"train from cached features in {self.args.feature_cache}.")
+
     def train_epoch(self, epoch):
         self.change_state(mode="train")
         self.logger.info(">>>>>> epochs: %d/%d"%(epoch, self.args.epochs))
@@ -111,12 +181,13 @@ class Trainer(TrainBase):
             # print(text.dtype)
             # text.float()
             # label.float()
-            image = image.to(self.rank, non_blocking=True)
+            image = self.image_to_device(image, crop=True)
             text = text.to(self.rank, non_blocking=True)
             # print("text shape:", text.shape)
             index = index.numpy()
             # print(text.shape)
-            hash_img, hash_text = self.model(image, text)
+            with self.autocast():
+                hash_img, hash_text = self.model(image, text)
             if self.args.hash_layer == "select":
                 hash_img = torch.cat(hash_img, dim=-1) if isinstance(hash_img, list) else hash_img.view(hash_img.shape[0], -1)
                 hash_text = torch.cat(hash_text, dim=-1)if isinstance(hash_text, list) else hash_text.view(hash_text.shape[0], -1)
@@ -125,8 +196,13 @@ class Trainer(TrainBase):
 
 
             self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+            if self.scaler is not None:
+                self.scaler.scale(loss).backward()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+            else:
+                loss.backward()
+                self.optimizer.step()
 
         self.logger.info(f">>>>>> [{epoch}/{self.args.epochs}] loss: {all_loss.data / (len(self.train_loader))}, lr: {'-'.join([str('%.9f'%itm) for itm in sorted(list(set(self.optimizer.get_lr())))])}")
 
@@ -189,11 +265,10 @@ class Trainer(TrainBase):
         
         return similarity, positive_loss, negative_loss
 
-    def make_hash_code(self, code: list) -> torch.Tensor:
-
-        code = torch.stack(code)
-        # print(code.shape)
-        code = code.permute(1, 0, 2)
+    def make_hash_code(self, code) -> torch.Tensor:
+        # code: (batch, bit, 2) softmax of HashLayer, or the list of per-bit (batch, 2) softmax of the old layout
+        if isinstance(code, list):
+            code = torch.stack(code).permute(1, 0, 2)
         hash_code = torch.argmax(code, dim=-1)
         hash_code[torch.where(hash_code == 0)] = -1
         hash_code = hash_code.float()
@@ -206,17 +281,32 @@ class Trainer(TrainBase):
         text_buffer = torch.empty(length, self.args.output_dim, dtype=torch.float).to(self.rank)
 
         for image, text, label, index in tqdm(data_loader):
-            image = image.to(self.rank, non_blocking=True)
+            image = self.image_to_device(image)
             text = text.to(self.rank, non_blocking=True)
             index = index.numpy()
-            image_hash = self.model.encode_image(image)
+            with self.autocast():
+                image_hash = self.model.encode_image(image)
+                text_hash = self.model.encode_text(text)
             image_hash = self.make_hash_code(image_hash)
-            text_hash = self.model.encode_text(text)
             text_hash = self.make_hash_code(text_hash)
             img_buffer[index, :] = image_hash.data
             text_buffer[index, :] = text_hash.data
         
         return img_buffer, text_buffer# img_buffer.to(self.rank), text_buffer.to(self.rank)
+
+    def detach_code(self, code) -> torch.Tensor:
+        # the same code get_code would produce for this model output
+        with torch.no_grad():
+            return self.make_hash_code(code) if self.args.hash_layer == "select" else code.data
+
+    def evaluate(self, qB, rB) -> dict:
+        # mAP, top-n precision, PR curve and radius precision of one direction from a single ranking pass
+        return self.evaluator.evaluate(qB, rB)
+
+    def pack_code(self, code: torch.Tensor):
+        if self.args.hamming_backend == "packed":
+            return PackedCodes.from_codes(code)
+        return code
         
     def our_loss(self, image, text, label, epoch, times):
         loss = 0
@@ -256,19 +346,62 @@ class Trainer(TrainBase):
     
     def compute_loss(self, image, text, label, epoch, times):
 
-        query_img, query_txt = self.get_code(self.query_loader, self.args.query_num) if self.args.hash_layer == "select" else super().get_code(self.query_loader, self.args.query_num)
-        retrieval_img, retrieval_txt = self.get_code(self.retrieval_loader, self.args.retrieval_num) if self.args.hash_layer == "select" else super().get_code(self.retrieval_loader, self.args.retrieval_num)
-        
-        retrieval_img = retrieval_img.T 
-        retrieval_txt = retrieval_txt.T 
-        asignment_loss = self.save_assignment(query_img, query_txt, retrieval_img, retrieval_txt)
-        asignment_loss = asignment_loss.to('cuda:0')           
-        loss = self.our_loss(image, text, label, epoch, times) + asignment_loss
-        loss = self.our_loss(image, text, label, epoch, times)        
+        loss = self.our_loss(image, text, label, epoch, times)
         loss = torch.sum(loss)
 
         return loss
 
+    def run(self):
+        if self.args.ingest != "":
+            self.ingest()
+        else:
+            super().run()
+
+    def ingest(self):
+        """
+        encode the records appended to the --ingest queue file with the current model and append their codes to
+        the --code-store stores. the queue offset after the last stored batch is kept in ingest.offset next to the
+        stores, a restarted job resumes there (a batch stored just before a crash may be stored again).
+        """
+        if self.args.code_store == "":
+            raise RuntimeError("ingest step must write to a code store! please set the --code-store argument.")
+        self.change_state(mode="valid")
+        os.makedirs(self.args.code_store, exist_ok=True)
+        offset_path = os.path.join(self.args.code_store, "ingest.offset")
+        offset = 0
+        if os.path.exists(offset_path):
+            with open(offset_path, "r") as f:
+                offset = int(f.read().strip() or 0)
+        num_classes = self.retrieval_labels.shape[1]
+        encoder = BaseDataset([], [], [], is_train=False, maxWords=self.args.max_words, imageResolution=self.args.resolution,
+                              image_shards=self.args.image_shards, raw_images=self.args.preprocess == "device")
+        stream = RecordStream(self.args.ingest, encoder, num_classes, batch_size=self.args.batch_size, offset=offset,
+                              max_wait=self.args.ingest_wait, idle_timeout=self.args.ingest_idle)
+        # one worker reads ahead at most two batches, the reader waits while the model is busy
+        loader = DataLoader(stream, batch_size=None, num_workers=1, prefetch_factor=2) if self.args.num_workers > 0 else DataLoader(stream, batch_size=None)
+        self.logger.info(f"ingest {self.args.ingest} from offset {offset}.")
+
+        stores = None
+        with torch.no_grad():
+            for image, text, label, ids, offset in loader:
+                with self.autocast():
+                    img_code = self.detach_code(self.model.encode_image(self.image_to_device(image)))
+                    txt_code = self.detach_code(self.model.encode_text(text.to(self.rank, non_blocking=True)))
+                if stores is None:
+                    stores = [self.open_code_store(name, img_code.shape[1], num_classes) for name in ["img", "txt"]]
+                for store, code in zip(stores, (img_code, txt_code)):
+                    store.append(code, label, ids.numpy())
+                with open(offset_path + ".tmp", "w") as f:
+                    f.write(str(int(offset)))
+                os.replace(offset_path + ".tmp", offset_path)
+                self.logger.info(f"ingest: {ids.shape[0]} items stored, {len(stores[0])} codes in store, offset {int(offset)}.")
+
+    def open_code_store(self, name: str, bit: int, num_classes: int):
+        path = self.code_store_path(name)
+        if os.path.exists(path):
+            return CodeStore(path, mode="r+")
+        return CodeStore.create(path, bit, num_classes, model_version=os.path.basename(self.args.pretrained))
+
     def test(self, mode_name="i2t"):
         if self.args.pretrained == "":
             raise RuntimeError("test step must load a model! please set the --pretrained argument.")
@@ -276,12 +409,15 @@ class Trainer(TrainBase):
         save_dir = os.path.join(self.args.save_dir, "PR_cruve")
         os.makedirs(save_dir, exist_ok=True)
         query_img, query_txt = self.get_code(self.query_loader, self.args.query_num) if self.args.hash_layer == "select" else super().get_code(self.query_loader, self.args.query_num)
-        retrieval_img, retrieval_txt = self.get_code(self.retrieval_loader, self.args.retrieval_num) if self.args.hash_layer == "select" else super().get_code(self.retrieval_loader, self.args.retrieval_num)
-        mAPi2t = calc_map_k(query_img, retrieval_txt, self.query_labels, self.retrieval_labels, None, self.rank)
+        retrieval_img, retrieval_txt, new_rows = self.get_retrieval_code()
+        q_img, q_txt, r_img, r_txt = map(self.pack_code, (query_img, query_txt, retrieval_img, retrieval_txt))
+        result_i2t = self.evaluate(q_img, r_txt)
+        result_t2i = self.evaluate(q_txt, r_img)
+        mAPi2t = result_i2t["map"]
         # print("map map")
-        mAPt2i = calc_map_k(query_txt, retrieval_img, self.query_labels, self.retrieval_labels, None, self.rank)
-        mAPi2i = calc_map_k(query_img, retrieval_img, self.query_labels, self.retrieval_labels, None, self.rank)
-        mAPt2t = calc_map_k(query_txt, retrieval_txt, self.query_labels, self.retrieval_labels, None, self.rank)
+        mAPt2i = result_t2i["map"]
+        mAPi2i = self.evaluate(q_img, r_img)["map"]
+        mAPt2t = self.evaluate(q_txt, r_txt)["map"]
         self.max_mapt2i = max(self.max_mapt2i, mAPt2i)
         self.logger.info(f">>>>>> MAP(i->t): {mAPi2t}, MAP(t->i): {mAPt2i}, MAP(t->t): {mAPt2t}, MAP(i->i): {mAPi2i}")
 
@@ -298,22 +434,31 @@ class Trainer(TrainBase):
             'r_img': retrieval_img,
             'r_txt': retrieval_txt,
             'q_l': query_labels,
-            'r_l': retrieval_labels
+            'r_l': retrieval_labels,
+            'pr_i2t': np.stack(result_i2t["pr"]),
+            'pr_t2i': np.stack(result_t2i["pr"]),
+            'topn_i2t': np.asarray(result_i2t["topn"]),
+            'topn_t2i': np.asarray(result_t2i["topn"])
         }
         scio.savemat(os.path.join(save_dir, str(self.args.output_dim) + "-ours-" + self.args.dataset + "-" + mode_name + ".mat"), result_dict)
         self.logger.info(">>>>>> save all data!")
+        if self.args.save_index:
+            self.save_index(retrieval_img, retrieval_txt)
+        if self.args.code_store != "":
+            self.save_code_store(retrieval_img, retrieval_txt, self.retrieval_labels, self.retrieval_loader.dataset.ids, new_rows)
 
 
     def valid(self, epoch):
         self.logger.info("Valid.")
         self.change_state(mode="valid")
         query_img, query_txt = self.get_code(self.query_loader, self.args.query_num) if self.args.hash_layer == "select" else super().get_code(self.query_loader, self.args.query_num)
-        retrieval_img, retrieval_txt = self.get_code(self.retrieval_loader, self.args.retrieval_num) if self.args.hash_layer == "select" else super().get_code(self.retrieval_loader, self.args.retrieval_num)
-        mAPi2t = calc_map_k(query_img, retrieval_txt, self.query_labels, self.retrieval_labels, None, self.rank)
+        retrieval_img, retrieval_txt, _ = self.get_retrieval_code()
+        q_img, q_txt, r_img, r_txt = map(self.pack_code, (query_img, query_txt, retrieval_img, retrieval_txt))
+        mAPi2t = self.evaluate(q_img, r_txt)["map"]
         # print("map map")
-        mAPt2i = calc_map_k(query_txt, retrieval_img, self.query_labels, self.retrieval_labels, None, self.rank)
-        mAPi2i = calc_map_k(query_img, retrieval_img, self.query_labels, self.retrieval_labels, None, self.rank)
-        mAPt2t = calc_map_k(query_txt, retrieval_txt, self.query_labels, self.retrieval_labels, None, self.rank)
+        mAPt2i = self.evaluate(q_txt, r_img)["map"]
+        mAPi2i = self.evaluate(q_img, r_img)["map"]
+        mAPt2t = self.evaluate(q_txt, r_txt)["map"]
         if self.max_mapi2t < mAPi2t:
             self.best_epoch_i = epoch
             self.save_mat(query_img, query_txt, retrieval_img, retrieval_txt, mode_name="i2t")
@@ -352,138 +497,78 @@ class Trainer(TrainBase):
         return
 
 
-    def save_assignment(self, query_img, query_txt, retrieval_img, retrieval_txt):
-        query_img = query_img.cpu().detach().numpy()
-        query_txt = query_txt.cpu().detach().numpy()
-        retrieval_img = retrieval_img.cpu().detach().numpy()
-        retrieval_txt = retrieval_txt.cpu().detach().numpy()
-        query_labels = self.query_labels.numpy()
-        retrieval_labels = self.retrieval_labels.numpy()       
-        
-
-        np.save('query_img_old.npy', query_img)
-        np.save('query_txt_old.npy', query_txt)
-        np.save('retrieval_img_old.npy', retrieval_img)
-        np.save('retrieval_txt_old.npy', retrieval_txt)
-
-        # loaded_q_img_np = np.load('query_img_old.npy')
-        # query_img_old = torch.from_numpy(loaded_q_img_np)
-        # loaded_q_txt_np = np.load('query_txt_old.npy')
-        # query_txt_old = torch.from_numpy(loaded_q_txt_np)
-        # loaded_r_img_np = np.load('retrieval_img_old.npy')
-        # retrieval_img_old = torch.from_numpy(loaded_r_img_np)
-        # loaded_r_txt_np = np.load('retrieval_txt_old.npy')
-        # retrieval_txt_old = torch.from_numpy(loaded_r_txt_np)
-        
-        a = len(self.train_loader.dataset)
-        query_img = torch.from_numpy(query_img)
-        retrieval_img = torch.from_numpy(retrieval_img)
-        dot_product = np.dot(query_img, retrieval_img) 
-        norm_a = np.linalg.norm(query_img)  
-        norm_b = np.linalg.norm(retrieval_img) 
-        cosine_similarity = dot_product / (norm_a * norm_b)  
-        cosine_distance = 1 - cosine_similarity
-        cosine_distance_hf = cosine_similarity      
-        cosine_distance_img = torch.from_numpy(cosine_distance)
-        cosine_distance_img = cosine_distance_img[:649, :]
-
-        retrieval_txt = torch.from_numpy(retrieval_txt)
-        query_txt = torch.from_numpy(query_txt)
-        dot_product = np.dot(query_txt, retrieval_txt)  
-        norm_a = np.linalg.norm(query_txt)  
-        norm_b = np.linalg.norm(retrieval_txt)  
-        cosine_similarity = dot_product / (norm_a * norm_b)  
-        cosine_distance = 1 - cosine_similarity
-        cosine_distance_txt = torch.from_numpy(cosine_distance)
-        cosine_distance_txt = cosine_distance_txt[:649, :]        
-
-        query_txt = query_txt.T 
-        dot_product = np.dot(query_img, query_txt)  
-        norm_a = np.linalg.norm(query_img)  
-        norm_b = np.linalg.norm(query_txt)  
-        cosine_similarity = dot_product / (norm_a * norm_b)  
-        cosine_distance = 1 - cosine_similarity
-        cosine_distance_q = torch.from_numpy(cosine_distance)
-        cosine_distance_q = cosine_distance_q[:649, :649]        
-
-        retrieval_img = retrieval_img.T
-        dot_product = np.dot(retrieval_img, retrieval_txt)  
-        norm_a = np.linalg.norm(retrieval_img)  
-        norm_b = np.linalg.norm(retrieval_txt)  
-        cosine_similarity = dot_product / (norm_a * norm_b)   
-        cosine_distance = 1 - cosine_similarity
-        cosine_distance_retrieval = torch.from_numpy(cosine_distance)
-
-        retrieval_labels = retrieval_labels.T
-        dot_product = np.dot(query_labels, retrieval_labels)  
-        norm_a = np.linalg.norm(query_labels) 
-        norm_b = np.linalg.norm(retrieval_labels)  
-        cosine_similarity = dot_product / (norm_a * norm_b)  
-        cosine_distance = 1 - cosine_similarity
-        cosine_distance_labels = torch.from_numpy(cosine_distance)
-
-   
-        # N, D = retrieval_img_old.shape
-#         M, _ = query_img_old.shape
-#         prod = torch.mm(query_img_old, retrieval_img_old)  # 形状为 [D, M]
-#         K = torch.diag(torch.ones(4413))  
-#         S = (cosine_distance_hf + 1) / 2  
-#         S = torch.from_numpy(S)
-#         S2 = torch.mm(S, S.T)
-#         S2 = S2.T
-                
-#         query_img_old = query_img_old.T
-#         query_img_old = torch.mm(query_img_old, query_img_old.T)  # 形状为 (4413, 4413)
-#         retrieval_img_old_transpose = retrieval_img_old.T
-#         retrieval_img_old_transpose = torch.mm(retrieval_img_old_transpose, retrieval_img_old_transpose.T)  # 形状为 (4413, 4413)
-#         retrieval_txt_old_transpose = retrieval_txt_old.T
-#         retrieval_txt_old_transpose = torch.mm(retrieval_txt_old_transpose, retrieval_txt_old_transpose.T)  # 形状为 (4413, 4413)
-#         retrieval_img_old_transpose[retrieval_img_old_transpose == 0] += 1e-6
-#         img_weight_matrix_part = torch.matmul(retrieval_img_old, torch.pinverse(retrieval_img_old_transpose))
-#         retrieval_img_old = retrieval_img_old.T
-#         img_weight_matrix_part = torch.matmul(retrieval_img_old, img_weight_matrix_part)
-#         S1 = S[:649, :649]
-        
-#         img_weight_matrix_part = torch.matmul(img_weight_matrix_part, S1)
-#         retrieval_txt_old_transpose[retrieval_txt_old_transpose == 0] += 1e-6
-#         retrieval_txt_old = retrieval_txt_old.T
-#         txt_weight_matrix_part = torch.matmul(torch.pinverse(retrieval_txt_old_transpose),retrieval_txt_old)
-        
-#         txt_weight_matrix_part = txt_weight_matrix_part.T
-#         img_weight_matrix_part = img_weight_matrix_part[:, :128]
-#         W = torch.matmul(img_weight_matrix_part, txt_weight_matrix_part)
-#         W = torch.mm(W, W.T)
-#         S2 = S2[:649, :649]
-#         S = S2*W
-#         K = K[:649, :649]
-#         KS = torch.mm(K, S.T)  
-#         prod = prod[:649, :]
-#         result = prod - KS 
-#         f_loss_1 = torch.norm(result, p='fro') ** 2
-#         e = 1e-9
-#         f_loss_1 = f_loss_1 * e
-       
-
-#         retrieval_img = retrieval_img.T
-#         query_img_old = query_img_old.T
-#         prod = torch.mm(query_img_old, retrieval_img)  
-#         small_values_tensor = torch.randn(649, 649) * 1e-6               
-#         small_values_tensor[:128, :649] = prod
-#         prod = small_values_tensor[:649, :649].clone()
-#         result = prod - KS         
-#         f_loss_2 = torch.norm(result, p='fro') ** 2
-#         e = 1e-9
-#         f_loss_2 = f_loss_2 * e
-        
-        
-      
-        cosine_distance = cosine_distance_img + cosine_distance_txt + cosine_distance_q + cosine_distance_retrieval + cosine_distance_labels
-        
-
-        # cosine_distance = cosine_distance_img + cosine_distance_txt + cosine_distance_q + cosine_distance_retrieval + cosine_distance_labels + f_loss_1 + f_loss_2
-       
-        return cosine_distance
-        # return
-        
-
-
+    def code_store_path(self, name: str):
+        return os.path.join(self.args.code_store, str(self.args.output_dim) + "-ours-" + self.args.dataset + "-" + name + ".codes")
+
+    def open_code_stores(self):
+        # (img store, txt store) of the retrieval set, None if there is no stored code yet
+        img_path, txt_path = self.code_store_path("img"), self.code_store_path("txt")
+        if not (os.path.exists(img_path) and os.path.exists(txt_path)):
+            return None
+        img_store, txt_store = CodeStore(img_path), CodeStore(txt_path)
+        if len(img_store) == 0:
+            return None
+        if img_store.bit != self.args.output_dim:
+            raise ValueError("code store %s holds %d-bit codes, but output dim is %d." % (img_path, img_store.bit, self.args.output_dim))
+        if not np.array_equal(img_store.ids, txt_store.ids):
+            raise ValueError("code stores %s and %s hold different items." % (img_path, txt_path))
+        return img_store, txt_store
+
+    def get_retrieval_code(self):
+        """
+        codes of the retrieval set. with --lifelong the codes of items already in the code store are frozen,
+        they are read from the store and only the new items are encoded by the current model.
+        :return: img codes, txt codes and the rows of the new items
+        """
+        dataset = self.retrieval_loader.dataset
+        stores = self.open_code_stores() if self.args.lifelong else None
+        if stores is None:
+            retrieval_img, retrieval_txt = self.get_code(self.retrieval_loader, self.args.retrieval_num) if self.args.hash_layer == "select" else super().get_code(self.retrieval_loader, self.args.retrieval_num)
+            return retrieval_img, retrieval_txt, np.arange(len(dataset))
+
+        img_store, txt_store = stores
+        sorter = np.argsort(img_store.ids, kind="stable")
+        pos = np.minimum(np.searchsorted(img_store.ids, dataset.ids, sorter=sorter), len(img_store) - 1)
+        found = img_store.ids[sorter[pos]] == dataset.ids
+        old_rows, new_rows = np.nonzero(found)[0], np.nonzero(~found)[0]
+        new_loader = DataLoader(
+                dataset=Subset(dataset, new_rows),
+                batch_size=self.args.batch_size,
+                num_workers=self.args.num_workers,
+                pin_memory=True,
+                collate_fn=self.collate_fn
+            )
+        retrieval_img, retrieval_txt = self.get_code(new_loader, self.args.retrieval_num) if self.args.hash_layer == "select" else super().get_code(new_loader, self.args.retrieval_num)
+        store_rows = sorter[pos[found]]
+        index = torch.from_numpy(old_rows).to(retrieval_img.device)
+        retrieval_img[index] = torch.from_numpy(PackedCodes(img_store.words[store_rows], img_store.bit).unpack()).to(retrieval_img.device)
+        retrieval_txt[index] = torch.from_numpy(PackedCodes(txt_store.words[store_rows], txt_store.bit).unpack()).to(retrieval_txt.device)
+        self.logger.info(f"lifelong: {len(old_rows)} frozen codes of model '{img_store.model_version}', {len(new_rows)} new items encoded.")
+        return retrieval_img, retrieval_txt, new_rows
+
+    def save_code_store(self, img_code, txt_code, labels, ids, rows):
+        """
+        write the retrieval codes of `rows` to the code stores, with --lifelong they are appended to the
+        existing stores so the next update keeps them frozen, otherwise the stores are rewritten.
+        """
+        os.makedirs(self.args.code_store, exist_ok=True)
+        model_version = os.path.basename(self.args.pretrained)
+        labels = torch.as_tensor(labels)[torch.from_numpy(rows)]
+        for name, code in [("img", img_code), ("txt", txt_code)]:
+            path = self.code_store_path(name)
+            if self.args.lifelong:
+                store = self.open_code_store(name, code.shape[1], labels.shape[1])
+            else:
+                store = CodeStore.create(path, code.shape[1], labels.shape[1], model_version=model_version)
+            if len(rows) > 0:
+                store.append(code[rows], labels, ids[rows])
+            self.logger.info(f"save {len(rows)} codes to {path}, {len(store)} codes in store.")
+
+    def save_index(self, retrieval_img, retrieval_txt):
+
+        num_tables = self.args.index_tables if self.args.index_tables > 0 else None
+        for name, code in [("img", retrieval_img), ("txt", retrieval_txt)]:
+            index = MultiIndexHashing.build(code, num_tables=num_tables)
+            path = os.path.join(self.args.save_dir, str(self.args.output_dim) + "-ours-" + self.args.dataset + "-" + name + ".mih")
+            index.save(path)
+            self.logger.info(f"save multi-index hashing index ({index.num_tables} tables, {len(index)} codes) to {path}")
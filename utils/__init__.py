@@ -1,3 +1,7 @@
 from .utils import *
 from .logger import get_logger, get_summary_writer
-from .get_args import get_args
\ No newline at end of file
+from .get_args import get_args
+from .packed_codes import PackedCodes
+from .mih import MultiIndexHashing
+from .code_store import CodeStore
+from .label_index import LabelIndex
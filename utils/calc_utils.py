@@ -2,8 +2,12 @@ import torch
 import numpy as np
 from tqdm import tqdm
 
+from .packed_codes import PackedCodes
+
 
 def calc_hammingDist(B1, B2):
+    if isinstance(B1, PackedCodes):
+        return torch.from_numpy(B1.hamming(B2)).float()
     q = B2.shape[1]
     if len(B1.shape) < 2:
         B1 = B1.unsqueeze(0)
@@ -14,7 +18,7 @@ def calc_hammingDist(B1, B2):
 def calc_map_k_matrix(qB, rB, query_L, retrieval_L, k=None, rank=0):
     
     num_query = query_L.shape[0]
-    if qB.is_cuda:
+    if not isinstance(qB, PackedCodes) and qB.is_cuda:
         qB = qB.cpu()
         rB = rB.cpu()
     map = 0
@@ -40,8 +44,9 @@ def calc_map_k_matrix(qB, rB, query_L, retrieval_L, k=None, rank=0):
 def calc_map_k(qB, rB, query_L, retrieval_L, k=None, rank=100):
 
     num_query = query_L.shape[0]
-    qB = torch.sign(qB)
-    rB = torch.sign(rB)
+    if not isinstance(qB, PackedCodes):
+        qB = torch.sign(qB)
+        rB = torch.sign(rB)
     map = 0
     if k is None:
         k = retrieval_L.shape[0]
@@ -67,19 +72,101 @@ def calc_map_k(qB, rB, query_L, retrieval_L, k=None, rank=100):
     return map
 
 
+def _sign_codes(qB, rB, device):
+    # packed codes when either side is packed, otherwise sign codes on the device
+    if isinstance(qB, PackedCodes) or isinstance(rB, PackedCodes):
+        qB = qB if isinstance(qB, PackedCodes) else PackedCodes.from_codes(qB)
+        rB = rB if isinstance(rB, PackedCodes) else PackedCodes.from_codes(rB)
+        return qB, rB
+    return torch.sign(qB.float()).to(device), torch.sign(rB.float()).to(device)
+
+
+def hamming_argsort(bucket: torch.Tensor, num_buckets: int) -> torch.Tensor:
+    """
+    rank items by integer hamming bucket, ties keep the retrieval index order.
+    a b-bit code only has b + 1 distances, so on cpu this is a counting (radix) sort of numpy over
+    uint8 / uint16 keys which is linear in the number of items. other devices use a stable torch.sort.
+    :param bucket: int64 tensor with shape (m, n), values in [0, num_buckets)
+    :return: int64 tensor with shape (m, n), the retrieval index of every rank
+    """
+    if bucket.device.type != "cpu" or num_buckets > 2 ** 16:
+        return torch.sort(bucket, dim=-1, stable=True)[1]
+    if num_buckets > 2 ** 8 and not bool((bucket & 1).any()):
+        # only whole distances in the 2 x hamming buckets, halving keeps the order and fits uint8
+        bucket = bucket >> 1
+        num_buckets = (num_buckets + 1) // 2
+    key = bucket.numpy().astype(np.uint8 if num_buckets <= 2 ** 8 else np.uint16)
+    return torch.from_numpy(np.argsort(key, axis=-1, kind="stable"))
+
+
+def hamming_topk(bucket: torch.Tensor, num_buckets: int, k: int) -> torch.Tensor:
+    """
+    the first k columns of hamming_argsort with a partial selection instead of a full ranking.
+    bucket-major keys are unique, so ties still keep the retrieval index order.
+    :return: int64 tensor with shape (m, k)
+    """
+    num_retrieval = bucket.shape[1]
+    if k >= num_retrieval:
+        return hamming_argsort(bucket, num_buckets)
+    key = bucket * num_retrieval + torch.arange(num_retrieval, device=bucket.device)
+    return torch.topk(key, k, dim=-1, largest=False, sorted=True)[1]
+
+
+def calc_map_k_batched(qB, rB, query_L, retrieval_L, k=None, rank=0, block_size=256, device=None):
+    """
+    mAP@k computed on blocks of queries as matrices, without a python loop over queries.
+    items are ranked by hamming_topk (a full hamming_argsort without k), ties of hamming distance are ranked
+    by retrieval index, so the result is deterministic. k=None ranks the whole retrieval set and gives the same value as calc_map_k.
+    with k set, the AP of a query is averaged over the relevant items inside its top-k.
+    :param block_size: number of queries in one block, memory is about 32 x block_size x num_retrieval bytes
+    :param device: device to run on, default is the device of qB (cpu for PackedCodes)
+    """
+    if device is None:
+        device = qB.device if isinstance(qB, torch.Tensor) else torch.device("cpu")
+    qB, rB = _sign_codes(qB, rB, device)
+    query_L = query_L.to(device).float()
+    retrieval_L = retrieval_L.to(device).float()
+    num_query = query_L.shape[0]
+    num_retrieval = retrieval_L.shape[0]
+    if k is None or k > num_retrieval:
+        k = num_retrieval
+
+    position = torch.arange(1, k + 1, dtype=torch.float32, device=device)
+    num_buckets = 2 * rB.shape[1] + 1
+    ap_sum = 0.
+    for start in range(0, num_query, block_size):
+        end = min(start + block_size, num_query)
+        hamm = calc_hammingDist(qB[start: end], rB).to(device)
+        gnd = query_L[start: end].mm(retrieval_L.t()) > 0
+        # distances are multiples of 0.5
+        bucket = torch.round(hamm * 2).long()
+        del hamm
+        ind = hamming_topk(bucket, num_buckets, k).to(device)
+        del bucket
+        gnd = torch.gather(gnd, 1, ind).float()
+        del ind
+        right = gnd.cumsum(dim=-1)
+        ap = torch.sum(right / position * gnd, dim=-1) / right[:, -1].clamp(min=1)
+        ap_sum += ap.sum().item()
+
+    return torch.tensor(ap_sum / num_query)
+
+
 def calc_precisions_topn_matrix(qB, rB, query_L, retrieval_L, recall_gas=0.02, num_retrieval=10000):
-    if not isinstance(qB, torch.Tensor):
-        qB = torch.from_numpy(qB)
-        rB = torch.from_numpy(rB)
+    if isinstance(query_L, np.ndarray):
         query_L = torch.from_numpy(query_L)
         retrieval_L = torch.from_numpy(retrieval_L)
-    qB = qB.float()
-    rB = rB.float()
-    qB = torch.sign(qB - 0.5)
-    rB = torch.sign(rB - 0.5)
-    if qB.is_cuda:
-        qB = qB.cpu()
-        rB = rB.cpu()
+    if not isinstance(qB, PackedCodes):
+        if not isinstance(qB, torch.Tensor):
+            qB = torch.from_numpy(qB)
+            rB = torch.from_numpy(rB)
+        qB = qB.float()
+        rB = rB.float()
+        qB = torch.sign(qB - 0.5)
+        rB = torch.sign(rB - 0.5)
+        if qB.is_cuda:
+            qB = qB.cpu()
+            rB = rB.cpu()
     num_query = query_L.shape[0]
     # num_retrieval = retrieval_L.shape[0]
     precisions = [0] * int(1 / recall_gas)
@@ -103,10 +190,11 @@ def calc_precisions_topn_matrix(qB, rB, query_L, retrieval_L, recall_gas=0.02, n
 
 
 def calc_precisions_topn(qB, rB, query_L, retrieval_L, recall_gas=0.02, num_retrieval=10000):
-    qB = qB.float()
-    rB = rB.float()
-    qB = torch.sign(qB - 0.5)
-    rB = torch.sign(rB - 0.5)
+    if not isinstance(qB, PackedCodes):
+        qB = qB.float()
+        rB = rB.float()
+        qB = torch.sign(qB - 0.5)
+        rB = torch.sign(rB - 0.5)
     num_query = query_L.shape[0]
     # num_retrieval = retrieval_L.shape[0]
     precisions = [0] * int(1 / recall_gas)
@@ -131,10 +219,11 @@ def calc_precisions_topn(qB, rB, query_L, retrieval_L, recall_gas=0.02, num_retr
 
 
 def calc_precisions_hash(qB, rB, query_L, retrieval_L):
-    qB = qB.float()
-    rB = rB.float()
-    qB = torch.sign(qB - 0.5)
-    rB = torch.sign(rB - 0.5)
+    if not isinstance(qB, PackedCodes):
+        qB = qB.float()
+        rB = rB.float()
+        qB = torch.sign(qB - 0.5)
+        rB = torch.sign(rB - 0.5)
     num_query = query_L.shape[0]
     num_retrieval = retrieval_L.shape[0]
     bit = qB.shape[1]
@@ -166,9 +255,9 @@ def calc_precisions_hash(qB, rB, query_L, retrieval_L):
     return precisions, recalls
 
 def calc_precisions_hash_my(qB, rB, *, Gnd, num_query, num_retrieval):
-    if not isinstance(qB, torch.Tensor):
+    if isinstance(qB, np.ndarray):
         qB = torch.from_numpy(qB)
-    if not isinstance(rB, torch.Tensor):
+    if isinstance(rB, np.ndarray):
         rB = torch.from_numpy(rB)
     if not isinstance(Gnd, torch.Tensor):
         Gnd = torch.from_numpy(Gnd)
@@ -254,6 +343,180 @@ def calc_precisions_hamming_radius(qB, rB, query_L, retrieval_L, hamming_gas=1):
     return precisions
 
 
+def _stream_tile_size(num_query, num_retrieval, memory_limit, bytes_per_pair=64):
+    # about bytes_per_pair bytes of temporaries are alive for every (query, retrieval) pair of a tile
+    pairs = max(int(memory_limit) // bytes_per_pair, 1)
+    query_block = max(1, min(num_query, 256, pairs))
+    retrieval_tile = max(1, min(num_retrieval, pairs // query_block))
+    return query_block, retrieval_tile
+
+
+def _tile_bucket_positions(bucket, gnd, num_buckets):
+    """
+    1-based position of every item among the items of the same bucket in this tile, in index order.
+    :return: (position, relevant position, bucket histogram, relevant bucket histogram)
+    """
+    ones = torch.ones_like(bucket)
+    gnd = gnd.long()
+    hist = torch.zeros(bucket.shape[0], num_buckets, dtype=torch.long, device=bucket.device).scatter_add_(1, bucket, ones)
+    rel_hist = torch.zeros_like(hist).scatter_add_(1, bucket, gnd)
+    column = torch.arange(bucket.shape[1], device=bucket.device).expand_as(bucket)
+    order = hamming_argsort(bucket, num_buckets).to(bucket.device)
+    sorted_bucket = bucket.gather(1, order)
+    position = column + 1 - (hist.cumsum(dim=-1) - hist).gather(1, sorted_bucket)
+    rel_position = gnd.gather(1, order).cumsum(dim=-1) - (rel_hist.cumsum(dim=-1) - rel_hist).gather(1, sorted_bucket)
+    position = torch.empty_like(position).scatter_(1, order, position)
+    rel_position = torch.empty_like(rel_position).scatter_(1, order, rel_position)
+    return position, rel_position, hist, rel_hist
+
+
+def calc_rank_stats_stream(qB, rB, query_L, retrieval_L, k=None, topn=None, with_rank=True, memory_limit=512 * 2 ** 20, device=None, gnd_fn=None):
+    """
+    tiled evaluation over query blocks and retrieval tiles, the Q x N ground truth / hamming / rank
+    matrices are never materialized. ranking is by hamming distance, ties are ranked by retrieval index.
+    every query block makes two passes over the retrieval tiles:
+        1. histograms of hamming distance and of relevant items per query.
+        2. the global rank of every item is rebuilt from the histograms, then AP and top-n counts are accumulated.
+    :param k: mAP@k, None means the whole retrieval set
+    :param topn: list of n to count the relevant items in the top-n
+    :param with_rank: run the second pass, without it only the histograms are computed
+    :param memory_limit: bytes for the temporaries of one tile
+    :param gnd_fn: gnd_fn(start, end, r_start, r_end) returns the bool ground truth of a tile, default is computed from the labels
+    :return: dict with
+        ap: (Q,) AP@k of every query.
+        hist, rel_hist: (Q, 2 * bit + 1) histogram over 2 x hamming distance of all / relevant items.
+        topn_right: (len(topn),) number of relevant (query, item) pairs in the top-n of all queries.
+    """
+    if device is None:
+        device = qB.device if isinstance(qB, torch.Tensor) else torch.device("cpu")
+    qB, rB = _sign_codes(qB, rB, device)
+    query_L = torch.as_tensor(query_L)
+    retrieval_L = torch.as_tensor(retrieval_L)
+    num_query = query_L.shape[0]
+    num_retrieval = retrieval_L.shape[0]
+    num_buckets = 2 * rB.shape[1] + 1
+    if k is None or k > num_retrieval:
+        k = num_retrieval
+    thresholds = torch.tensor(list(topn) if topn is not None else [], dtype=torch.long, device=device)
+    query_block, retrieval_tile = _stream_tile_size(num_query, num_retrieval, memory_limit)
+
+    def tiles(start, end):
+        q_L = query_L[start: end].to(device).float()
+        for r_start in range(0, num_retrieval, retrieval_tile):
+            r_end = min(r_start + retrieval_tile, num_retrieval)
+            hamm = calc_hammingDist(qB[start: end], rB[r_start: r_end]).to(device)
+            bucket = torch.round(hamm * 2).long()
+            if gnd_fn is None:
+                gnd = q_L.mm(retrieval_L[r_start: r_end].to(device).float().t()) > 0
+            else:
+                gnd = gnd_fn(start, end, r_start, r_end).to(device)
+            yield bucket, gnd
+
+    ap = torch.zeros(num_query, dtype=torch.float64)
+    hist = torch.zeros(num_query, num_buckets, dtype=torch.long)
+    rel_hist = torch.zeros(num_query, num_buckets, dtype=torch.long)
+    topn_right = torch.zeros(thresholds.shape[0], dtype=torch.long, device=device)
+    for start in range(0, num_query, query_block):
+        end = min(start + query_block, num_query)
+        cnt = torch.zeros(end - start, num_buckets, dtype=torch.long, device=device)
+        rel = torch.zeros_like(cnt)
+        # a block with a single tile keeps it for the second pass instead of computing it again
+        block_tiles = list(tiles(start, end)) if retrieval_tile == num_retrieval else None
+        for bucket, gnd in block_tiles or tiles(start, end):
+            cnt.scatter_add_(1, bucket, torch.ones_like(bucket))
+            rel.scatter_add_(1, bucket, gnd.long())
+        hist[start: end] = cnt.cpu()
+        rel_hist[start: end] = rel.cpu()
+        if not with_rank:
+            continue
+        if block_tiles is not None:
+            # the tile holds the whole retrieval set, the rank is the position after sorting
+            bucket, gnd = block_tiles[0]
+            gnd = gnd.gather(1, hamming_argsort(bucket, num_buckets).to(device))
+            right = gnd.cumsum(dim=-1)
+            position = torch.arange(1, k + 1, dtype=torch.float64, device=device)
+            ap_sum = torch.sum(gnd[:, :k] * (right[:, :k] / position), dim=-1)
+            ap[start: end] = (ap_sum / right[:, k - 1].clamp(min=1)).cpu()
+            if thresholds.shape[0] > 0:
+                topn_right += right[:, thresholds.clamp(max=num_retrieval) - 1].sum(dim=0)
+            continue
+
+        cnt_lt = cnt.cumsum(dim=-1) - cnt
+        rel_lt = rel.cumsum(dim=-1) - rel
+        seen_cnt = torch.zeros_like(cnt)
+        seen_rel = torch.zeros_like(rel)
+        ap_sum = torch.zeros(end - start, dtype=torch.float64, device=device)
+        right_k = torch.zeros(end - start, dtype=torch.long, device=device)
+        for bucket, gnd in block_tiles or tiles(start, end):
+            position, rel_position, tile_cnt, tile_rel = _tile_bucket_positions(bucket, gnd, num_buckets)
+            rank = cnt_lt.gather(1, bucket) + seen_cnt.gather(1, bucket) + position
+            rel_rank = rel_lt.gather(1, bucket) + seen_rel.gather(1, bucket) + rel_position
+            hit = gnd & (rank <= k)
+            ap_sum += torch.sum(hit * (rel_rank.double() / rank.double()), dim=-1)
+            right_k += hit.sum(dim=-1)
+            if thresholds.shape[0] > 0:
+                topn_right += torch.bincount(torch.searchsorted(thresholds, rank[gnd]), minlength=thresholds.shape[0] + 1)[:-1].cumsum(dim=-1)
+            seen_cnt += tile_cnt
+            seen_rel += tile_rel
+        ap[start: end] = (ap_sum / right_k.clamp(min=1)).cpu()
+
+    return {
+        "ap": ap,
+        "hist": hist,
+        "rel_hist": rel_hist,
+        "topn_right": topn_right.cpu(),
+    }
+
+
+def _topn_thresholds(recall_gas, num_retrieval):
+    return [int(num_retrieval * recall) for recall in np.arange(recall_gas, 1 + recall_gas, recall_gas)][: int(1 / recall_gas)]
+
+
+def calc_map_k_stream(qB, rB, query_L, retrieval_L, k=None, memory_limit=512 * 2 ** 20, device=None):
+    """
+    mAP@k with a bounded memory, same value as calc_map_k_batched.
+    """
+    stats = calc_rank_stats_stream(qB, rB, query_L, retrieval_L, k=k, memory_limit=memory_limit, device=device)
+    return torch.tensor(stats["ap"].sum().item() / stats["ap"].shape[0])
+
+
+def calc_precisions_topn_stream(qB, rB, query_L, retrieval_L, recall_gas=0.02, num_retrieval=10000, memory_limit=512 * 2 ** 20, device=None):
+    """
+    precision of the top-n for n = num_retrieval * recall, same value as calc_precisions_topn_matrix.
+    """
+    thresholds = _topn_thresholds(recall_gas, num_retrieval)
+    stats = calc_rank_stats_stream(qB, rB, query_L, retrieval_L, topn=thresholds, memory_limit=memory_limit, device=device)
+    num_query = stats["ap"].shape[0]
+    return [right / total / num_query for right, total in zip(stats["topn_right"].tolist(), thresholds)]
+
+
+def pr_curve_from_hist(hist, rel_hist):
+    """
+    precision / recall at every hamming radius from the histograms of calc_rank_stats_stream,
+    same value as calc_precisions_hash.
+    """
+    # calc_precisions_hash casts the distance to uint8, which floors the half distances
+    num_radius = (hist.shape[1] + 1) // 2
+    radius = torch.arange(hist.shape[1]) // 2
+    recall_hist = torch.zeros(num_radius, dtype=torch.long).index_add_(0, radius, hist.sum(dim=0))
+    right_hist = torch.zeros(num_radius, dtype=torch.long).index_add_(0, radius, rel_hist.sum(dim=0))
+    max_hamm = int(torch.nonzero(recall_hist).max())
+    recall_num = recall_hist[: max_hamm + 1].cumsum(dim=0).numpy()
+    right_num = right_hist[: max_hamm + 1].cumsum(dim=0).numpy()
+    total_right = int(rel_hist.sum())
+    precisions = right_num / (recall_num + 1e-8)
+    recalls = recall_num / total_right
+    return precisions, recalls
+
+
+def calc_precisions_hash_stream(qB, rB, query_L, retrieval_L, memory_limit=512 * 2 ** 20, device=None):
+    """
+    PR curve over hamming radius with a bounded memory, only the first (histogram) pass is needed.
+    """
+    stats = calc_rank_stats_stream(qB, rB, query_L, retrieval_L, with_rank=False, memory_limit=memory_limit, device=device)
+    return pr_curve_from_hist(stats["hist"], stats["rel_hist"])
+
+
 def calc_neighbor(label1, label2):
     # calculate the similar matrix
     Sim = label1.matmul(label2.transpose(0, 1)) > 0
@@ -0,0 +1,118 @@
+import os
+import struct
+from typing import Union
+
+import numpy as np
+import torch
+
+from .packed_codes import PackedCodes, WORD_BITS
+
+
+class CodeStore(object):
+    """
+    on-disk hash code database, one fixed-size record per item:
+        id: int64 item id.
+        words: packed code, uint64 x ceil(bit / 64).
+        labels: packed multi-hot label, uint8 x ceil(num_classes / 8).
+    the records follow a 256-byte header (magic, format version, bit, num_classes, count, model version)
+    and are read through np.memmap without copying. append writes the new records at the end of the file
+    and then updates the count in the header, an interrupted append leaves the store at its old length.
+    """
+
+    MAGIC = b"DDLCHCS\x00"
+    FORMAT_VERSION = 1
+    HEADER_SIZE = 256
+    _HEADER = struct.Struct("<8sIIIQ64s")
+    _COUNT_OFFSET = 20
+
+    def __init__(self, path: str, mode="r"):
+        if mode not in ["r", "r+"]:
+            raise ValueError("mode must in ['r', 'r+'], but it is %s" % mode)
+        self.path = path
+        self.mode = mode
+        with open(path, "rb") as f:
+            magic, version, bit, num_classes, count, model_version = self._HEADER.unpack(f.read(self._HEADER.size))
+        if magic != self.MAGIC:
+            raise ValueError("%s is not a code store." % path)
+        if version != self.FORMAT_VERSION:
+            raise ValueError("code store format %d of %s is not supported." % (version, path))
+        self.bit = bit
+        self.num_classes = num_classes
+        self.model_version = model_version.rstrip(b"\x00").decode("utf-8")
+        self.dtype = np.dtype([
+            ("id", "<i8"),
+            ("words", "<u8", ((bit + WORD_BITS - 1) // WORD_BITS,)),
+            ("labels", "u1", ((num_classes + 7) // 8,)),
+        ])
+        self._count = count
+        self._map()
+
+    @classmethod
+    def create(cls, path: str, bit: int, num_classes: int, model_version=""):
+        model_version = model_version.encode("utf-8")
+        if len(model_version) > 64:
+            raise ValueError("model version is longer than 64 bytes.")
+        header = cls._HEADER.pack(cls.MAGIC, cls.FORMAT_VERSION, bit, num_classes, 0, model_version)
+        with open(path, "wb") as f:
+            f.write(header.ljust(cls.HEADER_SIZE, b"\x00"))
+        return cls(path, mode="r+")
+
+    def _map(self):
+        if self._count == 0:
+            self.records = np.empty((0,), dtype=self.dtype)
+        else:
+            self.records = np.memmap(self.path, dtype=self.dtype, mode="r", offset=self.HEADER_SIZE, shape=(self._count,))
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self.records["id"]
+
+    @property
+    def words(self) -> np.ndarray:
+        return self.records["words"]
+
+    @property
+    def packed_labels(self) -> np.ndarray:
+        return self.records["labels"]
+
+    def codes(self) -> PackedCodes:
+        return PackedCodes(self.words, self.bit)
+
+    def labels(self) -> torch.Tensor:
+        labels = np.unpackbits(self.packed_labels, axis=1, bitorder="little", count=self.num_classes)
+        return torch.from_numpy(labels)
+
+    def append(self, codes: Union[torch.Tensor, np.ndarray, PackedCodes], labels: Union[torch.Tensor, np.ndarray], ids=None):
+        """
+        add items at the end of the store, ids default to the row numbers.
+        """
+        if self.mode != "r+":
+            raise RuntimeError("code store %s is opened read only." % self.path)
+        if not isinstance(codes, PackedCodes):
+            codes = PackedCodes.from_codes(codes)
+        if codes.bit != self.bit:
+            raise ValueError("code length of store (%d) and appended codes (%d) is different." % (self.bit, codes.bit))
+        if isinstance(labels, torch.Tensor):
+            labels = labels.cpu().numpy()
+        labels = np.asarray(labels)
+        if labels.shape != (len(codes), self.num_classes):
+            raise ValueError("labels with shape %s do not match %d items of %d classes." % (str(labels.shape), len(codes), self.num_classes))
+        if ids is None:
+            ids = np.arange(self._count, self._count + len(codes))
+
+        records = np.empty((len(codes),), dtype=self.dtype)
+        records["id"] = np.asarray(ids).reshape(-1)
+        records["words"] = codes.words
+        records["labels"] = np.packbits(labels > 0, axis=1, bitorder="little")
+        with open(self.path, "r+b") as f:
+            f.seek(self.HEADER_SIZE + self._count * self.dtype.itemsize)
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+            self._count += len(codes)
+            f.seek(self._COUNT_OFFSET)
+            f.write(struct.pack("<Q", self._count))
+        self._map()
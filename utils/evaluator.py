@@ -0,0 +1,67 @@
+import numpy as np
+import torch
+
+from .calc_utils import calc_rank_stats_stream, pr_curve_from_hist, _topn_thresholds
+from .label_index import LabelIndex
+
+
+class RetrievalEvaluator(object):
+    """
+    evaluate a retrieval direction (qB -> rB) with one pass of calc_rank_stats_stream and derive
+    mAP, top-n precision, PR curve and hamming radius precision from the shared histograms and ranks.
+    the ground truth of every tile is read from a LabelIndex of the retrieval labels with bitset unions,
+    no float label matmul and no dense Q x N matrix, and it is shared by every direction.
+    """
+
+    def __init__(self,
+                query_L: torch.Tensor,
+                retrieval_L: torch.Tensor,
+                k=None,
+                recall_gas=0.02,
+                num_retrieval=10000,
+                hamming_gas=1,
+                memory_limit=512 * 2 ** 20,
+                device=None):
+        self.query_L = torch.as_tensor(query_L)
+        self.retrieval_L = torch.as_tensor(retrieval_L)
+        self.k = k
+        self.recall_gas = recall_gas
+        self.hamming_gas = hamming_gas
+        self.thresholds = _topn_thresholds(recall_gas, num_retrieval)
+        self.memory_limit = memory_limit
+        self.device = device
+
+        self.label_index = LabelIndex(self.retrieval_L)
+        self._ground_truth = self.label_index.gnd_fn(self.query_L)
+
+    def radius_precisions(self, hist, rel_hist, bit):
+        """
+        precision inside hamming radius r for r in [1, bit], same value as calc_precisions_hamming_radius
+        except for a radius holding exactly one item, which the squeeze() in there counts as two items.
+        """
+        radius = np.arange(1, bit + 1, self.hamming_gas)[: int(bit / self.hamming_gas)]
+        # hist is over 2 x hamming distance, so radius r covers the first 2r + 1 buckets
+        index = torch.from_numpy(2 * radius).long()
+        total = hist.cumsum(dim=-1)[:, index].double()
+        right = rel_hist.cumsum(dim=-1)[:, index].double()
+        precisions = torch.where(total > 0, right / total.clamp(min=1), torch.zeros_like(total))
+        return precisions.mean(dim=0).tolist()
+
+    def evaluate(self, qB, rB) -> dict:
+        """
+        :return: dict with
+            map: mAP@k as a tensor.
+            topn: precision of the top-n for every n in thresholds.
+            pr: (precisions, recalls) at every hamming radius.
+            radius: precision inside every hamming radius.
+        """
+        stats = calc_rank_stats_stream(qB, rB, self.query_L, self.retrieval_L, k=self.k, topn=self.thresholds,
+                                       memory_limit=self.memory_limit, device=self.device, gnd_fn=self._ground_truth)
+        num_query = self.query_L.shape[0]
+        bit = rB.shape[1]
+        return {
+            "map": torch.tensor(stats["ap"].sum().item() / num_query),
+            "topn": [right / total / num_query for right, total in zip(stats["topn_right"].tolist(), self.thresholds)],
+            "pr": pr_curve_from_hist(stats["hist"], stats["rel_hist"]),
+            "radius": self.radius_precisions(stats["hist"], stats["rel_hist"], bit),
+        }
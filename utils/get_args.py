@@ -14,9 +14,12 @@ def get_args():
     parser.add_argument("--index-file", type=str, default="index.mat")
     parser.add_argument("--caption-file", type=str, default="caption.mat")
     parser.add_argument("--label-file", type=str, default="label.mat")
+    parser.add_argument("--manifest", type=str, default="", help="manifest.json (or its directory) of a columnar dataset built by make_or5k.py, replaces the caption / index / label files.")
     parser.add_argument("--similarity-function", type=str, default="euclidean", help="choise form [cosine, euclidean]")
     parser.add_argument("--loss-type", type=str, default="l2", help="choise form [l1, l2]")
     parser.add_argument("--output-dim", type=int, default=128)
+    parser.add_argument("--eval-memory-limit", type=int, default=0, help="MB for the tiles of evaluation. 0: use 512 MB.")
+    parser.add_argument("--hamming-backend", type=str, default="matmul", help="choise from [matmul, packed]. packed: uint64 bit codes with XOR + popcount.")
     
     
     
@@ -24,6 +27,8 @@ def get_args():
     parser.add_argument("--max-words", type=int, default=64)
     parser.add_argument("--resolution", type=int, default=224)
     parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--length-bucket", type=int, default=0, help="batches per bucket of captions grouped by token length, the text encoder drops the padding of every batch. 0: random batches.")
+    parser.add_argument("--precision", type=str, default="fp32", help="choise from [fp32, fp16, bf16]. autocast for training (fp16 with loss scaling), half / bf16 clip backbone for test.")
     
     parser.add_argument("--num-workers", type=int, default=4)
     parser.add_argument("--query-num", type=int, default=7430)    
@@ -47,6 +52,25 @@ def get_args():
     parser.add_argument("--sim-threshold", type=float, default=0.1)
 
     parser.add_argument("--is-train", action="store_true")
+    parser.add_argument("--caption-cache", type=str, default="", help="directory of pre-tokenized captions, built on first use. empty: tokenize in every __getitem__.")
+    parser.add_argument("--preprocess", type=str, default="worker", help="choise from [worker, device]. device: loaders return uint8 images, ToTensor / Normalize run on whole batches on the device.")
+    parser.add_argument("--image-shards", type=str, default="", help="output directory of dataset/or5k/make_image_shards.py. empty: decode the jpg files.")
+    parser.add_argument("--feature-cache", type=str, default="", help="directory of cached clip embeddings, the hash layers are trained from them and the clip backbone is frozen.")
+    parser.add_argument("--code-store", type=str, default="", help="directory to write memory-mapped code stores of the retrieval set in test.")
+    parser.add_argument("--lifelong", action="store_true", help="freeze the retrieval codes in --code-store, only encode items that are not stored yet.")
+    parser.add_argument("--ingest", type=str, default="", help="queue file of json records to encode and append to --code-store instead of train / test.")
+    parser.add_argument("--ingest-wait", type=float, default=5.0, help="seconds a partial batch waits for more records.")
+    parser.add_argument("--ingest-idle", type=float, default=0, help="stop ingesting after this many seconds without new records. 0: never stop.")
+    parser.add_argument("--save-index", action="store_true", help="save multi-index hashing indexes of the retrieval codes in test.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address of serve.py.")
+    parser.add_argument("--port", type=int, default=8000, help="port of serve.py.")
+    parser.add_argument("--unix-socket", type=str, default="", help="serve.py listens on this unix socket instead of --host / --port.")
+    parser.add_argument("--serve-image-root", type=str, default="", help="directory the image paths of serve.py queries are read from. empty: only image_base64 queries.")
+    parser.add_argument("--serve-max-batch", type=int, default=64, help="queries encoded and searched together by serve.py.")
+    parser.add_argument("--serve-max-wait", type=float, default=5, help="ms a query of serve.py waits for other queries to batch with.")
+    parser.add_argument("--serve-search-block", type=int, default=65536, help="store rows of one block of the hamming scan of serve.py.")
+    parser.add_argument("--serve-log-interval", type=float, default=60, help="seconds between the scheduler metrics in the log of serve.py. 0: no log.")
+    parser.add_argument("--index-tables", type=int, default=0, help="substring tables of the multi-index hashing index. 0: output-dim // 16.")
 
     args = parser.parse_args()
 
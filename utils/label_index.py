@@ -0,0 +1,66 @@
+from typing import Union
+
+import numpy as np
+import torch
+
+from .packed_codes import popcount64
+
+
+def _to_bool(labels: Union[torch.Tensor, np.ndarray]) -> np.ndarray:
+    if isinstance(labels, torch.Tensor):
+        labels = labels.cpu().numpy()
+    return np.asarray(labels) > 0
+
+
+class LabelIndex(object):
+    """
+    inverted index from class to the retrieval items holding it, every class is a bitset of num_items bits
+    packed in uint64 words. a query is relevant to the items in the union of its class bitsets, the same as
+    query_L @ retrieval_L.T > 0 for multi-hot labels. queries with the same label share one union, so the
+    work grows with the distinct label sets (at most 2 ** num_classes) instead of the queries.
+    """
+
+    def __init__(self, retrieval_L: Union[torch.Tensor, np.ndarray]):
+        labels = _to_bool(retrieval_L)
+        self.num_items, self.num_classes = labels.shape
+        num_words = (self.num_items + 63) // 64
+        bits = np.zeros((self.num_classes, num_words * 64), dtype=bool)
+        bits[:, : self.num_items] = labels.T
+        self.bitsets = np.packbits(bits, axis=1, bitorder="little").view("<u8")
+
+    def _union(self, query_L) -> tuple:
+        # (bitsets of the distinct query labels, index of every query into them)
+        patterns, inverse = np.unique(_to_bool(query_L), axis=0, return_inverse=True)
+        unions = np.zeros((patterns.shape[0], self.bitsets.shape[1]), dtype="<u8")
+        for p, pattern in enumerate(patterns):
+            if pattern.any():
+                unions[p] = np.bitwise_or.reduce(self.bitsets[pattern], axis=0)
+        return unions, inverse.reshape(-1)
+
+    def num_relevant(self, query_L) -> np.ndarray:
+        """
+        :return: int64 array with the number of relevant retrieval items of every query
+        """
+        unions, inverse = self._union(query_L)
+        counts = popcount64(unions).sum(axis=1, dtype=np.int64)
+        return counts[inverse]
+
+    def is_relevant(self, query_label, item: int) -> bool:
+        classes = _to_bool(query_label).reshape(-1)
+        word, bit = item // 64, item % 64
+        return bool(np.any((self.bitsets[classes, word] >> np.uint64(bit)) & np.uint64(1)))
+
+    def gnd_fn(self, query_L):
+        """
+        :return: gnd_fn(start, end, r_start, r_end) for calc_rank_stats_stream, the bool ground truth of a tile
+        """
+        unions, inverse = self._union(query_L)
+
+        def ground_truth(start, end, r_start, r_end):
+            w_start, w_end = r_start // 64, (r_end + 63) // 64
+            # only the words of the tile's queries are unpacked
+            words = unions[inverse[start: end], w_start: w_end]
+            bits = np.unpackbits(np.ascontiguousarray(words).view(np.uint8), axis=1, bitorder="little")
+            return torch.from_numpy(bits[:, r_start - w_start * 64: r_end - w_start * 64].astype(bool))
+
+        return ground_truth
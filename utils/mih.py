@@ -0,0 +1,162 @@
+import itertools
+from functools import lru_cache
+from typing import Union
+
+import numpy as np
+import torch
+
+from .packed_codes import PackedCodes, packed_hamming_dist
+
+
+@lru_cache()
+def _flip_masks(length: int, radius: int) -> np.ndarray:
+    # all masks of `length` bits with exactly `radius` bits set
+    masks = [sum(1 << i for i in flip) for flip in itertools.combinations(range(length), radius)]
+    return np.asarray(masks, dtype=np.uint64)
+
+
+class MultiIndexHashing(object):
+    """
+    multi-index hashing (Norouzi et al.) over packed hash codes.
+    every code is split into `num_tables` disjoint substrings and every substring has its own hash table.
+    two codes within distance r have at least one substring within distance r // num_tables, so a query
+    only probes the substring buckets close to its own substrings and verifies those candidates with
+    XOR + popcount instead of scanning the whole database.
+    """
+
+    def __init__(self, bit: int, num_tables=None):
+        self.bit = bit
+        self.num_tables = num_tables if num_tables is not None else max(1, bit // 16)
+        bounds = np.linspace(0, bit, self.num_tables + 1).round().astype(int)
+        self.slices = [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:])]
+        if max(b - a for a, b in self.slices) > 63:
+            raise ValueError("substrings of %d-bit codes in %d tables are longer than 63 bits." % (bit, self.num_tables))
+        self.tables = [dict() for _ in range(self.num_tables)]
+        self.words = np.empty((0, (bit + 63) // 64), dtype="<u8")
+        self.ids = np.empty((0,), dtype=np.int64)
+
+    @classmethod
+    def build(cls, codes: Union[torch.Tensor, np.ndarray, PackedCodes], ids=None, num_tables=None):
+        bit = codes.shape[1]
+        index = cls(bit, num_tables)
+        index.insert(codes, ids)
+        return index
+
+    def __len__(self):
+        return self.words.shape[0]
+
+    def _substrings(self, words: np.ndarray) -> np.ndarray:
+        # (n, num_tables) int values of the substrings
+        bits = np.unpackbits(np.ascontiguousarray(words).view(np.uint8), axis=1, bitorder="little")
+        keys = np.zeros((words.shape[0], self.num_tables), dtype=np.uint64)
+        for t, (a, b) in enumerate(self.slices):
+            weight = np.left_shift(np.uint64(1), np.arange(b - a, dtype=np.uint64))
+            keys[:, t] = (bits[:, a: b].astype(np.uint64) * weight).sum(axis=1, dtype=np.uint64)
+        return keys
+
+    def insert(self, codes: Union[torch.Tensor, np.ndarray, PackedCodes], ids=None):
+        """
+        add codes to the index, ids default to the insertion order.
+        """
+        if not isinstance(codes, PackedCodes):
+            codes = PackedCodes.from_codes(codes)
+        if codes.bit != self.bit:
+            raise ValueError("code length of index (%d) and inserted codes (%d) is different." % (self.bit, codes.bit))
+        start = len(self)
+        if ids is None:
+            ids = np.arange(start, start + len(codes), dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        if ids.shape[0] != len(codes):
+            raise ValueError("got %d ids for %d codes." % (ids.shape[0], len(codes)))
+
+        keys = self._substrings(codes.words)
+        for t, table in enumerate(self.tables):
+            for row, key in enumerate(keys[:, t].tolist(), start=start):
+                bucket = table.get(key)
+                if bucket is None:
+                    table[key] = [row]
+                else:
+                    bucket.append(row)
+        self.words = np.concatenate([self.words, codes.words])
+        self.ids = np.concatenate([self.ids, ids])
+
+    def _candidates(self, keys: np.ndarray, radius: int) -> np.ndarray:
+        # rows with some substring at exactly `radius` from the query substring
+        rows = []
+        for t, (a, b) in enumerate(self.slices):
+            if radius > b - a:
+                continue
+            table = self.tables[t]
+            for key in (np.uint64(keys[t]) ^ _flip_masks(b - a, radius)).tolist():
+                bucket = table.get(key)
+                if bucket is not None:
+                    rows.append(bucket)
+        if len(rows) == 0:
+            return np.empty((0,), dtype=np.int64)
+        return np.unique(np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64))
+
+    def _query_words(self, query) -> np.ndarray:
+        if not isinstance(query, PackedCodes):
+            query = PackedCodes.from_codes(query)
+        if query.bit != self.bit:
+            raise ValueError("code length of index (%d) and query (%d) is different." % (self.bit, query.bit))
+        return query.words
+
+    def range_search(self, query, radius: int) -> list:
+        """
+        all items within hamming distance `radius` of every query.
+        :return: a list with one (ids, distances) pair per query, sorted by distance then insertion order
+        """
+        q_words = self._query_words(query)
+        q_keys = self._substrings(q_words)
+        results = []
+        for i in range(q_words.shape[0]):
+            rows = [self._candidates(q_keys[i], s) for s in range(radius // self.num_tables + 1)]
+            rows = np.unique(np.concatenate(rows))
+            dist = packed_hamming_dist(q_words[i: i + 1], self.words[rows], num_threads=1)[0]
+            keep = dist <= radius
+            rows, dist = rows[keep], dist[keep]
+            order = np.lexsort((rows, dist))
+            results.append((self.ids[rows[order]], dist[order]))
+        return results
+
+    def knn_search(self, query, k: int):
+        """
+        k nearest items of every query, ties are broken by insertion order.
+        the substring radius grows until k candidates are within the distance covered by the probed buckets.
+        :return: (ids, distances), int64 / int32 arrays with shape (num_query, k), padded with -1 if the index has fewer items
+        """
+        q_words = self._query_words(query)
+        q_keys = self._substrings(q_words)
+        num_query = q_words.shape[0]
+        out_ids = np.full((num_query, k), -1, dtype=np.int64)
+        out_dist = np.full((num_query, k), -1, dtype=np.int32)
+        max_sub = max(b - a for a, b in self.slices)
+        for i in range(num_query):
+            rows = np.empty((0,), dtype=np.int64)
+            dist = np.empty((0,), dtype=np.int32)
+            for s in range(max_sub + 1):
+                new_rows = np.setdiff1d(self._candidates(q_keys[i], s), rows, assume_unique=True)
+                if new_rows.shape[0] > 0:
+                    new_dist = packed_hamming_dist(q_words[i: i + 1], self.words[new_rows], num_threads=1)[0]
+                    rows = np.concatenate([rows, new_rows])
+                    dist = np.concatenate([dist, new_dist])
+                # after probing substring radius s every item within num_tables * (s + 1) - 1 has been seen
+                if np.count_nonzero(dist <= self.num_tables * (s + 1) - 1) >= k:
+                    break
+            order = np.lexsort((rows, dist))[:k]
+            out_ids[i, :order.shape[0]] = self.ids[rows[order]]
+            out_dist[i, :order.shape[0]] = dist[order]
+        return out_ids, out_dist
+
+    def save(self, path: str):
+        # the hash tables are rebuilt from the codes on load
+        with open(path, "wb") as f:
+            np.savez(f, words=self.words, ids=self.ids, bit=self.bit, num_tables=self.num_tables)
+
+    @classmethod
+    def load(cls, path: str):
+        data = np.load(path)
+        index = cls(int(data["bit"]), int(data["num_tables"]))
+        index.insert(PackedCodes(data["words"], index.bit), data["ids"])
+        return index
@@ -0,0 +1,181 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union
+
+import numpy as np
+import torch
+
+
+WORD_BITS = 64
+
+# popcount of every byte value, used when numpy has no native bitwise_count (numpy < 2.0)
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount64(x: np.ndarray) -> np.ndarray:
+    """
+    count the set bits of every element of a uint64 array.
+    :param x: uint64 array of any shape
+    :return: uint8 array with the same shape as x
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    x = np.ascontiguousarray(x)
+    return _POPCOUNT_TABLE[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def pack_codes(codes: Union[torch.Tensor, np.ndarray]) -> np.ndarray:
+    """
+    pack sign codes into little-endian uint64 words, a positive value becomes bit 1.
+    :param codes: a tensor or array with shape (n, bit), values in {-1, +1} or {0, 1}
+    :return: uint64 array with shape (n, ceil(bit / 64))
+    """
+    if isinstance(codes, torch.Tensor):
+        codes = codes.detach().cpu().numpy()
+    codes = np.asarray(codes)
+    if codes.ndim < 2:
+        codes = codes.reshape(1, -1)
+    bit = codes.shape[1]
+    num_words = (bit + WORD_BITS - 1) // WORD_BITS
+    bits = np.zeros((codes.shape[0], num_words * WORD_BITS), dtype=np.uint8)
+    bits[:, :bit] = codes > 0
+    packed = np.packbits(bits, axis=1, bitorder="little")
+    return np.ascontiguousarray(packed).view("<u8")
+
+
+def unpack_codes(words: np.ndarray, bit: int) -> np.ndarray:
+    """
+    inverse of pack_codes.
+    :return: float32 array with shape (n, bit), values in {-1, +1}
+    """
+    words = np.ascontiguousarray(words, dtype="<u8")
+    bits = np.unpackbits(words.view(np.uint8), axis=1, bitorder="little")[:, :bit]
+    return bits.astype(np.float32) * 2 - 1
+
+
+def packed_hamming_dist(q_words: np.ndarray, r_words: np.ndarray, block_size=256, num_threads=None) -> np.ndarray:
+    """
+    hamming distance between packed codes with XOR + popcount, query blocks run on a thread pool.
+    :param q_words: uint64 array with shape (m, w)
+    :param r_words: uint64 array with shape (n, w)
+    :param block_size: number of query rows in one block, a block holds block_size x n int32 values
+    :param num_threads: worker threads, default is os.cpu_count()
+    :return: int32 array with shape (m, n)
+    """
+    if q_words.shape[1] != r_words.shape[1]:
+        raise ValueError("code length of query (%d words) and retrieval (%d words) is different." % (q_words.shape[1], r_words.shape[1]))
+    num_query = q_words.shape[0]
+    dist = np.empty((num_query, r_words.shape[0]), dtype=np.int32)
+    # column-major words give a contiguous (n,) row for every word index
+    r_columns = np.ascontiguousarray(r_words.T)
+
+    def run_block(start):
+        end = min(start + block_size, num_query)
+        out = dist[start: end]
+        out.fill(0)
+        for w in range(r_columns.shape[0]):
+            out += popcount64(np.bitwise_xor(q_words[start: end, w, None], r_columns[w][None, :]))
+
+    starts = range(0, num_query, block_size)
+    num_threads = num_threads or os.cpu_count() or 1
+    if num_threads <= 1 or num_query <= block_size:
+        for start in starts:
+            run_block(start)
+    else:
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            list(pool.map(run_block, starts))
+    return dist
+
+
+def packed_topk(q_words: np.ndarray, r_words: np.ndarray, k: int, block_size=65536, num_threads=None) -> tuple:
+    """
+    k nearest retrieval codes of every query, ties are broken by retrieval row. the retrieval codes are
+    scanned in blocks of block_size rows on a thread pool and only the top k of every block is kept, so a
+    scan holds m x block_size distances instead of m x n.
+    :param q_words: uint64 array with shape (m, w)
+    :param r_words: uint64 array with shape (n, w)
+    :return: (rows, distances), int64 / int32 arrays with shape (m, min(k, n))
+    """
+    num_query, num_retrieval = q_words.shape[0], r_words.shape[0]
+    k = min(k, num_retrieval)
+    if k <= 0:
+        return np.empty((num_query, 0), dtype=np.int64), np.empty((num_query, 0), dtype=np.int32)
+
+    def run_block(start):
+        end = min(start + block_size, num_retrieval)
+        dist = packed_hamming_dist(q_words, r_words[start: end], num_threads=1)
+        # distance-major keys are unique, the smallest k keys are the top k with ties in row order
+        keys = dist.astype(np.int64) * num_retrieval + np.arange(start, end)
+        return np.partition(keys, k - 1, axis=1)[:, :k] if k < end - start else keys
+
+    starts = range(0, num_retrieval, block_size)
+    num_threads = num_threads or os.cpu_count() or 1
+    if num_threads <= 1 or len(starts) == 1:
+        blocks = [run_block(start) for start in starts]
+    else:
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            blocks = list(pool.map(run_block, starts))
+    keys = np.concatenate(blocks, axis=1)
+    if k < keys.shape[1]:
+        keys = np.partition(keys, k - 1, axis=1)[:, :k]
+    keys = np.sort(keys, axis=1)
+    return keys % num_retrieval, (keys // num_retrieval).astype(np.int32)
+
+
+class PackedCodes(object):
+    """
+    hash codes stored as packed bits, a 128-bit code takes 16 bytes instead of 512 bytes of float32.
+    it can be passed in place of qB / rB to every metric of utils.calc_utils.
+    """
+
+    def __init__(self, words: np.ndarray, bit: int):
+        words = np.ascontiguousarray(words, dtype="<u8")
+        if words.ndim != 2 or words.shape[1] != (bit + WORD_BITS - 1) // WORD_BITS:
+            raise ValueError("words with shape %s can not hold %d-bit codes." % (str(words.shape), bit))
+        self.words = words
+        self.bit = bit
+
+    @classmethod
+    def from_codes(cls, codes: Union[torch.Tensor, np.ndarray]):
+        bit = codes.shape[-1]
+        return cls(pack_codes(codes), bit)
+
+    @property
+    def shape(self):
+        return (self.words.shape[0], self.bit)
+
+    @property
+    def nbytes(self):
+        return self.words.nbytes
+
+    def __len__(self):
+        return self.words.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            item = item[0]
+        if isinstance(item, torch.Tensor):
+            item = item.cpu().numpy()
+        if isinstance(item, (int, np.integer)):
+            item = slice(item, item + 1 if item != -1 else None)
+        return PackedCodes(self.words[item], self.bit)
+
+    def unpack(self) -> np.ndarray:
+        return unpack_codes(self.words, self.bit)
+
+    def hamming(self, other, block_size=256, num_threads=None) -> np.ndarray:
+        if not isinstance(other, PackedCodes):
+            other = PackedCodes.from_codes(other)
+        if other.bit != self.bit:
+            raise ValueError("code length of query (%d) and retrieval (%d) is different." % (self.bit, other.bit))
+        return packed_hamming_dist(self.words, other.words, block_size=block_size, num_threads=num_threads)
+
+    def topk(self, other, k: int, block_size=65536, num_threads=None) -> tuple:
+        """
+        :return: (rows of other, distances) of the k nearest codes of other, see packed_topk
+        """
+        if not isinstance(other, PackedCodes):
+            other = PackedCodes.from_codes(other)
+        if other.bit != self.bit:
+            raise ValueError("code length of query (%d) and retrieval (%d) is different." % (self.bit, other.bit))
+        return packed_topk(self.words, other.words, k, block_size=block_size, num_threads=num_threads)
@@ -6,6 +6,8 @@ from torch.nn import functional as F
 
 from sklearn.metrics.pairwise import euclidean_distances
 
+from .packed_codes import PackedCodes
+
 
 def compute_metrics(x):
     # 取复值的原因在于cosine的值越大说明越相似，但是需要取的是前N个值，所以取符号变为增函数s
@@ -87,8 +89,9 @@ def calc_map_k(qB, rB, query_L, retrieval_L, k=None, rank=0):
     # query_L: {0,1}^{mxl}
     # retrieval_L: {0,1}^{nxl}
     num_query = query_L.shape[0]
-    qB = torch.sign(qB)
-    rB = torch.sign(rB)
+    if not isinstance(qB, PackedCodes):
+        qB = torch.sign(qB)
+        rB = torch.sign(rB)
     map = 0
     if k is None:
         k = retrieval_L.shape[0]
@@ -147,6 +150,8 @@ def softmax_hash(code: Union[torch.Tensor, np.ndarray], dim_alph=0.25):
 
 def calcHammingDist(B1, B2):
 
+    if isinstance(B1, PackedCodes):
+        return torch.from_numpy(B1.hamming(B2)).float()
     if len(B1.shape) < 2:
         B1.view(1, -1)
     if len(B2.shape) < 2: